@@ -0,0 +1,88 @@
+"""
+generates a synthetic data folder of cards, for the benchmarks in bench/run.py
+the same parameters and seed always generate the same corpus
+"""
+
+from __future__ import annotations
+
+import random
+from dataclasses import dataclass
+from pathlib import Path
+
+from PIL import Image
+
+words = (
+    "the of and to in is that for it as with was on be by this are from or have "
+    "an which not but at all were we when your can there use each how their if "
+    "will other about many then them these so some would make like into time has "
+    "look two more write go see number way could people than first water been "
+    "call who oil its now find long down day did get come made may part"
+).split()
+
+
+@dataclass
+class Corpus:
+    cards: int = 1000
+    decks: int = 4
+    images: int = 100
+    image_size: int = 400  # pixels, width and height
+    reverse_ratio: float = 0.2  # of cards with a reverse prompt
+    math_density: float = 0.3  # chance of math per paragraph
+    code_density: float = 0.1  # chance of a code block per card
+    seed: int = 0
+
+    def deck_names(self) -> list[str]:
+        return [f"deck{i}" for i in range(self.decks)]
+
+    def generate(self, folder: Path):
+        r = random.Random(self.seed)
+        with_image = set(r.sample(range(self.cards), min(self.images, self.cards)))
+        for i in range(self.cards):
+            deck = self.deck_names()[i % self.decks]
+            path = folder / deck / f"part{i % 7}" / f"card{i:06}.md"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            image = None
+            if i in with_image:
+                image = f"image{i:06}.png"
+                noise(r, self.image_size).save(path.parent / image)
+            path.write_text(self.card(r, image))
+
+    def card(self, r: random.Random, image: None | str) -> str:
+        question = [self.paragraph(r) for _ in range(r.randint(1, 2))]
+        if image is not None:
+            question.append(f"![]({image})")
+        answer = [self.paragraph(r) for _ in range(r.randint(1, 3))]
+        if r.random() < self.code_density:
+            answer.append(self.code(r))
+        if r.random() < self.reverse_ratio:
+            answer.append(f"! {sentence(r, 3, 8)}")
+        return "\n\n".join([*question, "---", *answer]) + "\n"
+
+    def paragraph(self, r: random.Random) -> str:
+        parts = [sentence(r, 5, 20) for _ in range(r.randint(1, 3))]
+        if r.random() < self.math_density:
+            parts.append(
+                r.choice(
+                    ["$x^2 + y^2 = z^2$", "$\\sum_{i=0}^n i$", "$$e^{i\\pi} + 1 = 0$$"]
+                )
+            )
+        if r.random() < 0.3:
+            parts.append(f"with *{r.choice(words)}* and `{r.choice(words)}()`")
+        return " ".join(parts)
+
+    def code(self, r: random.Random) -> str:
+        lines = [
+            f"    {r.choice(words)} = {r.randint(0, 99)}"
+            for _ in range(r.randint(2, 6))
+        ]
+        return "```python\ndef f():\n" + "\n".join(lines) + "\n```"
+
+
+def sentence(r: random.Random, low: int, high: int) -> str:
+    text = " ".join(r.choice(words) for _ in range(r.randint(low, high)))
+    return text[0].upper() + text[1:] + "."
+
+
+def noise(r: random.Random, size: int) -> Image.Image:
+    # NOTE random pixels, that is the worst case for png compression
+    return Image.frombytes("RGB", (size, size), r.randbytes(size * size * 3))
@@ -0,0 +1,98 @@
+"""
+latency of the commands an editor runs, with and without 'cman daemon', on a synthetic corpus
+'python bench/daemon.py --repeat 10'
+"""
+
+from __future__ import annotations
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from corpus import Corpus
+
+from cman.client import socket_path
+from cman.data import Meta, write_meta
+
+
+def timed(args: list[str], env: dict[str, str], cwd: Path) -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", "from cman.client import main; main()", *args],
+        env=env,
+        cwd=cwd,
+        capture_output=True,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def main(
+    cards: Annotated[int, typer.Option(help="cards in the corpus")] = 1000,
+    repeat: Annotated[int, typer.Option(help="runs per command, times two")] = 5,
+):
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "data"
+        Corpus(cards=cards, decks=2, images=0).generate(base)
+        (base / "config.toml").write_text(
+            'path = "."\npandoc_workers = 1\n[decks]\ndeck0 = "id-deck0"\ndeck1 = "id-deck1"\n'
+        )
+        (base / "credentials.toml").write_text('[mochi]\ntoken = "token"\n')
+        paths = sorted(base.rglob("card*.md"))
+        write_meta(
+            base,
+            {p.relative_to(base): Meta(f"id{i}", None) for i, p in enumerate(paths)},
+        )
+        env = os.environ | {"cman_base": str(base), "XDG_CACHE_HOME": f"{tmp}/cache"}
+        card = paths[0].relative_to(base)
+        names = [card.name, f"renamed-{card.name}"]
+        # NOTE the i-th run of a command, rename goes back and forth
+        commands = {
+            "show": lambda i: ["show", str(card)],
+            "which": lambda i: ["which", "id1"],
+            "rename": lambda i: [
+                "rename",
+                str(card.with_name(names[i % 2])),
+                names[(i + 1) % 2],
+            ],
+        }
+
+        def run_all(env: dict[str, str]) -> dict[str, list[float]]:
+            # NOTE an even number of runs, so that rename ends where it started
+            return {
+                name: [timed(args(i), env, base) for i in range(2 * repeat)]
+                for name, args in commands.items()
+            }
+
+        without = run_all(env | {"cman_no_daemon": "1"})
+
+        daemon = subprocess.Popen(
+            [sys.executable, "-c", "from cman.cli import app; app()", "daemon"],
+            env=env,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            while not os.path.exists(socket_path(base)):
+                time.sleep(0.1)
+            with_daemon = run_all(env)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+        for name in commands:
+            a = statistics.median(without[name]) * 1000
+            b = statistics.median(with_daemon[name]) * 1000
+            print(f"{name}: {a:.0f}ms without, {b:.0f}ms with the daemon, {a / b:.1f}x")
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,134 @@
+"""
+end-to-end benchmark of 'cman sync' against bench/fake_mochi.py, on a synthetic corpus, see bench/corpus.py
+a first sync pushes everything, a second finds nothing to do, a third pushes a few edited cards
+'python bench/e2e.py --cards 10000 --latency 0.05 --error-rate 0.01'
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Annotated
+
+import typer
+from werkzeug.serving import make_server
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from corpus import Corpus
+from fake_mochi import Faults, make_app
+
+from cman.api import MochiClient
+from cman.cache import Cache
+from cman.markdown import Engine
+from cman.sync import sync
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def print_stats(client: MochiClient):
+    for endpoint, stats in sorted(client.stats.items()):
+        print(
+            f"  {endpoint}: {stats.requests} requests, {stats.retries} retries, "
+            f"p50 {percentile(stats.latencies, 0.5) * 1000:.1f}ms, "
+            f"p95 {percentile(stats.latencies, 0.95) * 1000:.1f}ms, "
+            f"p99 {percentile(stats.latencies, 0.99) * 1000:.1f}ms"
+        )
+
+
+def main(
+    cards: Annotated[int, typer.Option(help="cards in the corpus")] = 10_000,
+    decks: Annotated[int, typer.Option()] = 4,
+    images: Annotated[int, typer.Option(help="cards with an image")] = 0,
+    edits: Annotated[
+        float, typer.Option(help="ratio of cards edited for the third sync")
+    ] = 0.01,
+    engine: Annotated[Engine, typer.Option()] = Engine.python,
+    jobs: Annotated[int, typer.Option()] = os.process_cpu_count() or 1,
+    connections: Annotated[int, typer.Option()] = 8,
+    client_rate: Annotated[
+        float, typer.Option(help="requests per second the client allows itself")
+    ] = 10,
+    fast: Annotated[bool, typer.Option(help="sync with --fast")] = False,
+    latency: Annotated[float, typer.Option(help="seconds added to every request")] = 0,
+    jitter: Annotated[
+        float, typer.Option(help="up to that many random seconds more")
+    ] = 0,
+    rate: Annotated[float, typer.Option(help="requests per second before 429s")] = 0,
+    throttle_rate: Annotated[float, typer.Option(help="chance of a 429")] = 0,
+    error_rate: Annotated[float, typer.Option(help="chance of a 5xx")] = 0,
+    max_page: Annotated[int, typer.Option(help="most cards per page")] = 100,
+    seed: Annotated[int, typer.Option()] = 0,
+):
+    faults = Faults(
+        latency=latency,
+        jitter=jitter,
+        rate=rate,
+        throttle_rate=throttle_rate,
+        error_rate=error_rate,
+        retry_after=0.1,
+        max_page=max_page,
+    )
+    app, state = make_app(faults, seed)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["cman_mochi_url"] = f"http://127.0.0.1:{server.port}/api/"
+
+    corpus = Corpus(cards, decks, images, seed=seed)
+    deck_ids = {name: f"id-{name}" for name in corpus.deck_names()}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "data"
+        corpus.generate(base)
+        cache = Cache(Path(tmp) / "cache")
+
+        def run(name: str):
+            client = MochiClient("token", rate=client_rate, connections=connections)
+            before = state.requests, state.injected
+            start = time.perf_counter()
+            sync(
+                client,
+                base,
+                deck_ids,
+                cache,
+                engine,
+                jobs,
+                connections,
+                fast,
+                0,
+                yes=True,
+            )
+            seconds = time.perf_counter() - start
+            requests = state.requests - before[0]
+            print(
+                f"{name}: {seconds:.2f}s, {requests} requests, {requests / seconds:.1f}/s, "
+                f"{state.injected - before[1]} injected faults"
+            )
+            print_stats(client)
+
+        run("push all")
+        assert len(state.cards) == sum(
+            1 + ("\n! " in p.read_text()) for p in base.rglob("*.md")
+        ), "not all cards were pushed"
+        run("no changes")
+        r = random.Random(seed)
+        paths = sorted(base.rglob("*.md"))
+        for path in r.sample(paths, max(1, int(len(paths) * edits))):
+            path.write_text(path.read_text() + "\nEdited.\n")
+        run("after edits")
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    typer.run(main)
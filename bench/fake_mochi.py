@@ -0,0 +1,174 @@
+"""
+a local stand-in for the parts of the mochi api that cman.api uses, with injected faults
+for benchmarks, see bench/e2e.py, and to try sync, backup, and their failure modes offline
+'python bench/fake_mochi.py --latency 0.05 --error-rate 0.01', then point cman at it
+with cman_mochi_url=http://127.0.0.1:5057/api/
+everything is in memory, and gone when it stops
+"""
+
+from __future__ import annotations
+
+import itertools
+import random
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Annotated
+
+import typer
+from flask import Flask, request
+
+
+@dataclass
+class Faults:
+    latency: float = 0  # seconds added to every request
+    jitter: float = 0  # up to that many seconds more, uniformly random
+    rate: float = 0  # requests per second, above that it's 429, 0 is no limit
+    throttle_rate: float = 0  # chance of a 429 anyway
+    error_rate: float = 0  # chance of a 500, 502, or 503
+    retry_after: float = 1  # seconds, sent with every 429
+    max_page: int = 100  # pages hold at most that many cards, whatever the limit
+    short_page_rate: float = 0  # chance that a page is shorter than it could be
+
+
+@dataclass
+class State:
+    cards: dict[str, dict] = field(default_factory=dict)
+    attachments: dict[tuple[str, str], bytes] = field(default_factory=dict)
+    ids: itertools.count = field(default_factory=itertools.count)
+    lock: Lock = field(default_factory=Lock)
+    # NOTE for the server side rate limit
+    window: list[float] = field(default_factory=list)
+    requests: int = 0
+    injected: int = 0
+
+
+def make_app(faults: Faults, seed: int = 0) -> tuple[Flask, State]:
+    app = Flask(__name__)
+    state = State()
+    r = random.Random(seed)
+
+    @app.before_request
+    def inject():
+        with state.lock:
+            state.requests += 1
+            delay = faults.latency + r.uniform(0, faults.jitter)
+            now = time.monotonic()
+            state.window = [t for t in state.window if t > now - 1]
+            limited = faults.rate > 0 and len(state.window) >= faults.rate
+            if not limited:
+                state.window.append(now)
+            throttled = limited or r.random() < faults.throttle_rate
+            failed = not throttled and r.random() < faults.error_rate
+            error = r.choice([500, 502, 503])
+            if throttled or failed:
+                state.injected += 1
+        time.sleep(delay)
+        if request.authorization is None:
+            return {"errors": ["not authorized"]}, 401
+        if throttled:
+            return "too many requests", 429, {"Retry-After": str(faults.retry_after)}
+        if failed:
+            return "injected failure", error
+
+    @app.get("/api/cards")
+    def list_cards():
+        limit = int(request.args.get("limit", 10))
+        start = int(request.args.get("bookmark", 0))
+        with state.lock:
+            cards = sorted(state.cards.values(), key=lambda c: c["id"])
+            if "deck-id" in request.args:
+                cards = [c for c in cards if c["deck-id"] == request.args["deck-id"]]
+            size = min(limit, faults.max_page)
+            if r.random() < faults.short_page_rate:
+                size = r.randint(1, size)
+            docs = cards[start : start + size]
+        # NOTE like mochi, the end is an empty page, not a short one
+        return {"docs": docs, "bookmark": str(start + len(docs))}
+
+    @app.post("/api/cards")
+    def create_card():
+        body = request.get_json()
+        with state.lock:
+            id = f"fake{next(state.ids):08}"
+            state.cards[id] = {
+                "id": id,
+                "content": body["content"],
+                "deck-id": body["deck-id"],
+                "archived?": False,
+                "review-reverse?": False,
+                "created-at": {"date": time.time()},
+            }
+            return state.cards[id]
+
+    @app.get("/api/cards/<id>")
+    def retrieve_card(id: str):
+        with state.lock:
+            if id not in state.cards:
+                return {"errors": ["not found"]}, 404
+            return state.cards[id]
+
+    @app.post("/api/cards/<id>")
+    def update_card(id: str):
+        body = request.get_json()
+        with state.lock:
+            if id not in state.cards:
+                return {"errors": ["not found"]}, 404
+            state.cards[id].update(
+                {k: v for k, v in body.items() if k in ["content", "deck-id"]}
+            )
+            return state.cards[id]
+
+    @app.delete("/api/cards/<id>")
+    def delete_card(id: str):
+        with state.lock:
+            if state.cards.pop(id, None) is None:
+                return {"errors": ["not found"]}, 404
+            return {}
+
+    @app.post("/api/cards/<id>/attachments/<name>")
+    def update_attachment(id: str, name: str):
+        with state.lock:
+            if id not in state.cards:
+                return {"errors": ["not found"]}, 404
+            state.attachments[(id, name)] = request.files["file"].read()
+            return {}
+
+    @app.get("/api/cards/<id>/attachments/<name>")
+    def retrieve_attachment(id: str, name: str):
+        with state.lock:
+            if (id, name) not in state.attachments:
+                return {"errors": ["not found"]}, 404
+            return state.attachments[(id, name)]
+
+    return app, state
+
+
+def main(
+    port: Annotated[int, typer.Option()] = 5057,
+    latency: Annotated[float, typer.Option(help="seconds added to every request")] = 0,
+    jitter: Annotated[
+        float, typer.Option(help="up to that many random seconds more")
+    ] = 0,
+    rate: Annotated[float, typer.Option(help="requests per second before 429s")] = 0,
+    throttle_rate: Annotated[float, typer.Option(help="chance of a 429")] = 0,
+    error_rate: Annotated[float, typer.Option(help="chance of a 5xx")] = 0,
+    max_page: Annotated[int, typer.Option(help="most cards per page")] = 100,
+    short_page_rate: Annotated[float, typer.Option(help="chance of a short page")] = 0,
+    seed: Annotated[int, typer.Option()] = 0,
+):
+    faults = Faults(
+        latency=latency,
+        jitter=jitter,
+        rate=rate,
+        throttle_rate=throttle_rate,
+        error_rate=error_rate,
+        max_page=max_page,
+        short_page_rate=short_page_rate,
+    )
+    app, _ = make_app(faults, seed)
+    app.run(port=port, threaded=True)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -0,0 +1,93 @@
+"""
+bytes and time of image encoding with different options, see cman.images
+on synthetic screenshots, flat colours and lines, and photos, smooth with some noise, saved as large jpegs
+'python bench/images.py --count 40 --threads 4'
+"""
+
+from __future__ import annotations
+
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated
+
+import typer
+from PIL import Image, ImageDraw, ImageFilter
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from cman.data import encode_image, encode_images, encoded_images
+from cman.images import ImageOptions
+
+variants = {
+    "png, the default": ImageOptions(),
+    "png, optimized": ImageOptions(optimize=True),
+    "png, 64 colours": ImageOptions(colors=64, optimize=True),
+    "jpeg": ImageOptions(format="jpeg"),
+    "webp": ImageOptions(format="webp"),
+    "auto": ImageOptions(format="auto"),
+    "auto, fast downscale": ImageOptions(format="auto", fast_downscale=True),
+    "auto, 30kB budget": ImageOptions(
+        format="auto", fast_downscale=True, max_bytes=30_000
+    ),
+}
+
+
+def screenshot(r: random.Random, width: int, height: int) -> Image.Image:
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    colors = [tuple(r.randrange(256) for _ in range(3)) for _ in range(6)]
+    for _ in range(40):
+        x, y = r.randrange(width), r.randrange(height)
+        w, h = r.randrange(20, width // 3), r.randrange(10, height // 6)
+        draw.rectangle((x, y, x + w, y + h), fill=r.choice(colors))
+    for y in range(0, height, 24):
+        draw.text((10, y), "".join(r.choices("abcdefgh ", k=80)), fill="black")
+    return image
+
+
+def photo(r: random.Random, width: int, height: int) -> Image.Image:
+    small = Image.frombytes("RGB", (8, 6), r.randbytes(8 * 6 * 3))
+    image = small.resize((width, height), Image.Resampling.BICUBIC)
+    noise = Image.effect_noise((width, height), 20).convert("RGB")
+    image = Image.blend(image, noise, 0.1)
+    return image.filter(ImageFilter.GaussianBlur(1))
+
+
+def main(
+    count: Annotated[int, typer.Option(help="images of each kind")] = 20,
+    threads: Annotated[int, typer.Option(help="for the threaded run")] = 4,
+    seed: Annotated[int, typer.Option()] = 0,
+):
+    r = random.Random(seed)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = []
+        for i in range(count):
+            path = Path(tmp) / f"screenshot{i}.png"
+            screenshot(r, 1600, 1000).save(path)
+            paths.append(path)
+            path = Path(tmp) / f"photo{i}.jpg"
+            photo(r, 3200, 2400).save(path, quality=92)
+            paths.append(path)
+        source = sum(p.stat().st_size for p in paths)
+        print(f"{len(paths)} images, {source / 1e6:.1f}MB of sources")
+
+        for name, options in variants.items():
+            encoded_images.clear()
+            start = time.perf_counter()
+            size = sum(len(encode_image(None, p, options)[0]) for p in paths)
+            seconds = time.perf_counter() - start
+            print(f"{name}: {size / 1e6:.2f}MB in {seconds:.2f}s")
+
+        options = variants["auto, fast downscale"]
+        encoded_images.clear()
+        start = time.perf_counter()
+        encode_images(None, {(p, options) for p in paths}, threads)
+        seconds = time.perf_counter() - start
+        print(f"auto, fast downscale, on {threads} threads: {seconds:.2f}s")
+
+
+if __name__ == "__main__":
+    typer.run(main)
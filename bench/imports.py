@@ -0,0 +1,126 @@
+"""
+import time of cli commands, and a budget for each of them
+light commands, like the ones called from an editor, must not import the heavy dependencies
+'python bench/imports.py' fails if a command imports what it should not, or takes longer than its budget
+budgets are in ms on a slow machine, scale them with --scale on faster or slower ones
+"""
+
+from __future__ import annotations
+
+import os
+import subprocess
+import sys
+import tempfile
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Annotated
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from corpus import Corpus
+
+from cman.data import Meta, write_meta
+
+heavy = ["PIL", "serde", "tqdm", "pydantic", "requests", "flask"]
+
+
+@dataclass
+class Budget:
+    args: list[str]  # {base} is replaced with the data folder
+    ms: float  # of all imports together
+    forbidden: list[str] = field(default_factory=lambda: heavy)
+
+
+budgets: dict[str, Budget] = {
+    "help": Budget(["--help"], 120, heavy + ["pandoc"]),
+    "which": Budget(["which", "id0"], 200, heavy + ["pandoc"]),
+    "state": Budget(["state", "json"], 200, heavy + ["pandoc"]),
+    "show": Budget(["show", "{base}/deck0/part0/card000000.md"], 350),
+    "rename": Budget(["rename", "{base}/deck1/part1/card000001.md", "renamed.md"], 350),
+    "move": Budget(["move", "{base}/deck0/part0/card000000.md", "deck1"], 350),
+    "sync --help": Budget(["sync", "--help"], 120, heavy + ["pandoc"]),
+}
+
+
+def measure(args: list[str], env: dict[str, str]) -> tuple[float, set[str]]:
+    """ms of all imports, and the names of all imported modules"""
+    code = "import sys; from cman.cli import app; app(sys.argv[1:])"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code, *args],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=False,
+    )
+    if result.returncode != 0:
+        print(result.stderr[-2000:], file=sys.stderr)
+        print(f"'cman {' '.join(args)}' failed.", file=sys.stderr)
+        raise typer.Exit(2)
+    us, modules = 0, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        modules.add(name.strip())
+        # NOTE nested imports are indented, and already in the cumulative time of their parent
+        if not name.startswith("  "):
+            us += int(cumulative)
+    return us / 1000, modules
+
+
+def measure_in_fresh_base(args: list[str], cache: Path) -> tuple[float, set[str]]:
+    """like measure, in a new data folder, commands like rename change it"""
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp)
+        Corpus(cards=8, decks=2, images=2, image_size=16).generate(base)
+        (base / "config.toml").write_text(
+            'path = "."\n[decks]\ndeck0 = "id-deck0"\ndeck1 = "id-deck1"\n'
+        )
+        (base / "credentials.toml").write_text('[mochi]\ntoken = "token"\n')
+        paths = sorted(base.rglob("card*.md"))
+        write_meta(
+            base,
+            {p.relative_to(base): Meta(f"id{i}", None) for i, p in enumerate(paths)},
+        )
+        env = os.environ | {"cman_base": str(base), "XDG_CACHE_HOME": str(cache)}
+        return measure([a.format(base=base) for a in args], env)
+
+
+def main(
+    scale: Annotated[float, typer.Option(help="multiplies all budgets")] = 1,
+    repeat: Annotated[
+        int, typer.Option(help="runs per command, the fastest counts")
+    ] = 3,
+):
+    failures = 0
+    # NOTE shared, so that the cache, like the pandoc version probe, is warm after the first run
+    cache = Path(tempfile.mkdtemp())
+    for name, budget in budgets.items():
+        runs = [measure_in_fresh_base(budget.args, cache) for _ in range(repeat)]
+        ms = min(ms for ms, _ in runs)
+        modules = runs[-1][1]
+
+        imported = sorted(
+            m
+            for m in budget.forbidden
+            if any(i == m or i.startswith(f"{m}.") for i in modules)
+        )
+        limit = budget.ms * scale
+        flags = []
+        if ms > limit:
+            flags.append(f"OVER BUDGET of {limit:.0f}ms")
+        if len(imported) > 0:
+            flags.append(f"IMPORTS {', '.join(imported)}")
+        failures += len(flags) > 0
+        print(f"{name}: {ms:.0f}ms, {len(modules)} modules {' '.join(flags)}")
+
+    if failures > 0:
+        raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
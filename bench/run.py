@@ -0,0 +1,260 @@
+"""
+benchmarks for the hot paths of the local pipeline, on a synthetic corpus, see bench/corpus.py
+'python bench/run.py --save bench/baseline.json' records a baseline
+'python bench/run.py --compare bench/baseline.json' flags what got slower than the threshold
+timings depend on the machine, compare only against baselines from the same machine
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import sys
+import tempfile
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Annotated
+
+import typer
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from corpus import Corpus
+
+from cman import api, workers
+from cman.cache import Cache
+from cman.data import Images, Meta, MetaDiff, encoded_images, get_cards
+from cman.markdown import Direction, Engine, Markdown
+from cman.state import MochiDiff
+
+
+@dataclass
+class Context:
+    base: Path
+    decks: list[str]
+    texts: dict[Path, str]  # relative to base
+    markdowns: dict[Path, Markdown]
+    cache_folder: Path
+
+
+type Benchmark = Callable[[Context], Callable[[], object]]
+
+
+def from_str(engine: Engine) -> Benchmark:
+    def setup(ctx: Context):
+        return lambda: [Markdown.from_str(t, engine) for t in ctx.texts.values()]
+
+    return setup
+
+
+def with_rewritten_images(ctx: Context):
+    def transform(path: str) -> tuple[str, str]:
+        return "@media/image.png", ""
+
+    return lambda: [
+        md.with_rewritten_images(transform) for md in ctx.markdowns.values()
+    ]
+
+
+def maybe_prompted(ctx: Context):
+    def f():
+        for md in ctx.markdowns.values():
+            md.maybe_prompted()
+            if md.has_reverse_prompt():
+                md.oriented(Direction.backward).maybe_prompted()
+
+    return f
+
+
+def as_mochi_md_str(engine: Engine) -> Benchmark:
+    def setup(ctx: Context):
+        prompted = [md.maybe_prompted() for md in ctx.markdowns.values()]
+        return lambda: [md.as_mochi_md_str(engine) for md in prompted]
+
+    return setup
+
+
+def images_collect(ctx: Context):
+    images = [
+        (path, str(image))
+        for path, md in ctx.markdowns.items()
+        for image in md.get_image_paths()
+    ]
+
+    def f():
+        for path, image in images:
+            Images.from_base(ctx.base / path.parent).collect(image)
+
+    return f
+
+
+def cards(jobs: int, cache: None | str) -> Benchmark:
+    """cache is None, 'cold', or 'warm'"""
+
+    def setup(ctx: Context):
+        def make() -> None | Cache:
+            match cache:
+                case None:
+                    return None
+                case "cold":
+                    return Cache(Path(tempfile.mkdtemp(dir=ctx.cache_folder)))
+                case _:
+                    return Cache(ctx.cache_folder / "warm")
+
+        if cache == "warm":
+            get_cards(ctx.base, ctx.markdowns, {}, make(), Engine.pandoc, jobs)
+        return lambda: get_cards(
+            ctx.base, ctx.markdowns, {}, make(), Engine.pandoc, jobs
+        )
+
+    return setup
+
+
+def meta_diff(ctx: Context):
+    state = {
+        p: Meta(f"f{i}", f"b{i}" if i % 5 == 0 else None)
+        for i, p in enumerate(ctx.texts)
+    }
+    # NOTE every tenth card changes, and every twentieth is new
+    target = {
+        p: Meta(f"n{i}" if i % 10 == 0 else m.forward, m.backward)
+        for i, (p, m) in enumerate(state.items())
+    }
+    target |= {
+        p.with_name(f"new{i}.md"): Meta(None, None)
+        for i, p in enumerate(ctx.texts)
+        if i % 20 == 0
+    }
+    return lambda: MetaDiff.from_states(state, target)
+
+
+def mochi_diff(ctx: Context):
+    cache = Cache(ctx.cache_folder / "warm")
+    _, new = get_cards(ctx.base, ctx.markdowns, {}, cache, Engine.pandoc, 1)
+    existing = {f"id{i}": card for i, card in enumerate(new)}
+    decks = {deck: f"deck-id-{deck}" for deck in ctx.decks}
+    remote = {
+        id: api.Card(
+            id=id,
+            content=card.content if i % 10 != 0 else "changed",
+            deck_id=decks[card.deck_name],
+        )
+        for i, (id, card) in enumerate(existing.items())
+    }
+    return lambda: MochiDiff.from_states(remote, existing, [], decks)
+
+
+benchmarks: dict[str, Benchmark] = {
+    "from_str pandoc": from_str(Engine.pandoc),
+    "from_str python": from_str(Engine.python),
+    "with_rewritten_images": with_rewritten_images,
+    "maybe_prompted": maybe_prompted,
+    "as_mochi_md_str pandoc": as_mochi_md_str(Engine.pandoc),
+    "as_mochi_md_str python": as_mochi_md_str(Engine.python),
+    "Images.collect": images_collect,
+    "get_cards jobs=1": cards(1, None),
+    "get_cards jobs=all": cards(os.process_cpu_count() or 1, None),
+    "get_cards jobs=all cold cache": cards(os.process_cpu_count() or 1, "cold"),
+    "get_cards jobs=all warm cache": cards(os.process_cpu_count() or 1, "warm"),
+    "MetaDiff.from_states": meta_diff,
+    "MochiDiff.from_states": mochi_diff,
+}
+
+
+def main(
+    cards: Annotated[int, typer.Option(help="cards in the corpus")] = 300,
+    decks: Annotated[int, typer.Option()] = 4,
+    images: Annotated[int, typer.Option(help="cards with an image")] = 30,
+    image_size: Annotated[int, typer.Option(help="width and height in pixels")] = 400,
+    reverse_ratio: Annotated[float, typer.Option()] = 0.2,
+    math_density: Annotated[float, typer.Option()] = 0.3,
+    code_density: Annotated[float, typer.Option()] = 0.1,
+    seed: Annotated[int, typer.Option()] = 0,
+    repeat: Annotated[
+        int, typer.Option(help="runs per benchmark, the fastest counts")
+    ] = 3,
+    only: Annotated[
+        None | str, typer.Option(help="only benchmarks with this in their name")
+    ] = None,
+    pandoc_workers: Annotated[int, typer.Option(help="see cman.workers")] = 0,
+    save: Annotated[
+        None | Path, typer.Option(help="write results as a baseline")
+    ] = None,
+    compare: Annotated[
+        None | Path, typer.Option(help="compare against a baseline")
+    ] = None,
+    threshold: Annotated[
+        float, typer.Option(help="relative slowdown that is a regression")
+    ] = 0.2,
+):
+    corpus = Corpus(
+        cards,
+        decks,
+        images,
+        image_size,
+        reverse_ratio,
+        math_density,
+        code_density,
+        seed,
+    )
+    workers.start(pandoc_workers)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "data"
+        corpus.generate(base)
+        cache_folder = Path(tmp) / "cache"
+        cache_folder.mkdir()
+        texts = {p.relative_to(base): p.read_text() for p in sorted(base.rglob("*.md"))}
+        ctx = Context(
+            base,
+            corpus.deck_names(),
+            texts,
+            {p: Markdown.from_str(t) for p, t in texts.items()},
+            cache_folder,
+        )
+
+        results: dict[str, float] = {}
+        for name, benchmark in benchmarks.items():
+            if only is not None and only not in name:
+                continue
+            f = benchmark(ctx)
+            seconds = []
+            for _ in range(repeat):
+                # NOTE like a new run of cman, the persistent cache is up to the benchmark
+                encoded_images.clear()
+                start = time.perf_counter()
+                f()
+                seconds.append(time.perf_counter() - start)
+            results[name] = min(seconds)
+            print(f"{name}: {results[name]:.3f}s")
+
+    if save is not None:
+        save.write_text(
+            json.dumps({"corpus": asdict(corpus), "results": results}, indent=4) + "\n"
+        )
+
+    if compare is not None:
+        baseline = json.loads(compare.read_text())
+        if baseline["corpus"] != asdict(corpus):
+            print("The baseline was made with a different corpus.", file=sys.stderr)
+            raise typer.Exit(2)
+        regressions = 0
+        for name, now in results.items():
+            if name not in baseline["results"]:
+                continue
+            ratio = now / baseline["results"][name]
+            flag = ""
+            if ratio > 1 + threshold:
+                flag = " REGRESSION"
+                regressions += 1
+            elif ratio < 1 - threshold:
+                flag = " faster"
+            print(f"{name}: {ratio:.2f}x of baseline{flag}")
+        if regressions > 0:
+            raise typer.Exit(1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
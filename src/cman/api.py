@@ -5,17 +5,204 @@ https://mochi.cards/docs/api/
 
 from __future__ import annotations
 
+import os
+import random
+import time
 from collections.abc import Iterator, Sequence
-from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
+from threading import Lock
 
 import requests
 from pydantic import BaseModel, ConfigDict, Field
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 
+from cman import profiling
 
-def url_at(at: str) -> str:
-    return f"https://app.mochi.cards/api/{at}"
+
+class ApiError(Exception):
+    def __init__(self, response: requests.Response):
+        super().__init__(
+            f"{response.request.method} {response.url} "
+            f"failed with {response.status_code}: {response.text}"
+        )
+        self.status_code = response.status_code
+        self.retry_after: None | float = None
+        try:
+            self.retry_after = float(response.headers.get("Retry-After", ""))
+        except ValueError:
+            pass
+
+    def is_transient(self) -> bool:
+        """rate limits and server errors, it might work if we try again later"""
+        return self.status_code == 429 or self.status_code >= 500
+
+
+@dataclass
+class TokenBucket:
+    """allows rate requests per second on average, and bursts of up to burst"""
+
+    rate: float
+    burst: float
+    tokens: float = 0
+    at: float = field(default_factory=time.monotonic)
+    lock: Lock = field(default_factory=Lock)
+
+    def __post_init__(self):
+        self.tokens = self.burst
+
+    def take(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.at) * self.rate)
+            self.at = now
+            self.tokens -= 1
+            # NOTE we might go negative, then we wait here for it, holding the lock
+            if self.tokens < 0:
+                time.sleep(-self.tokens / self.rate)
+
+
+@dataclass
+class EndpointStats:
+    requests: int = 0
+    retries: int = 0
+    seconds: float = 0
+    latencies: list[float] = field(default_factory=list)
+    bytes_sent: int = 0
+    bytes_received: int = 0
+
+
+class MochiClient:
+    """
+    a keep-alive session with connection pooling
+    retries transient errors with exponential backoff and jitter, honours Retry-After
+    rate limits on the client side, and counts requests, latency and bytes per endpoint
+    """
+
+    def __init__(
+        self,
+        token: str,
+        base_url: None | str = None,
+        timeout: tuple[float, float] = (10, 60),  # connect, read
+        retries: int = 4,
+        backoff: float = 0.5,
+        rate: float = 10,
+        burst: float = 20,
+        connections: int = 16,
+    ):
+        # NOTE $cman_mochi_url can point us at a stand-in, like bench/fake_mochi.py
+        self.base_url = base_url or os.environ.get(
+            "cman_mochi_url", "https://app.mochi.cards/api/"
+        )
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.bucket = TokenBucket(rate, burst)
+        self.session = requests.Session()
+        self.session.auth = HTTPBasicAuth(token, "")
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.lock = Lock()
+        self.stats: dict[str, EndpointStats] = {}
+        # NOTE the size of a page that is known to be full, see iterate_paged_docs
+        self.full_page: None | int = None
+
+    def request(
+        self, method: str, at: str, endpoint: str, **kwargs
+    ) -> requests.Response:
+        """
+        at is the path of the url, endpoint is the name in stats, eg 'GET cards/:id'
+        raises ApiError if it fails, or still fails after retries
+        """
+        with profiling.span(endpoint):
+            return self.request_with_retries(method, at, endpoint, **kwargs)
+
+    def request_with_retries(
+        self, method: str, at: str, endpoint: str, **kwargs
+    ) -> requests.Response:
+        url = f"{self.base_url}{at}"
+        for attempt in range(self.retries + 1):
+            self.bucket.take()
+            start = time.monotonic()
+            try:
+                response = self.session.request(
+                    method, url, timeout=self.timeout, **kwargs
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(endpoint, attempt, time.monotonic() - start, None)
+                if attempt == self.retries:
+                    raise
+                time.sleep(self.backoff_for(attempt))
+                continue
+            self.record(endpoint, attempt, time.monotonic() - start, response)
+            if response.status_code == 200:
+                return response
+            error = ApiError(response)
+            if not error.is_transient() or attempt == self.retries:
+                raise error
+            delay = error.retry_after
+            if delay is None:
+                delay = self.backoff_for(attempt)
+            time.sleep(delay)
+        assert False
+
+    def backoff_for(self, attempt: int) -> float:
+        # NOTE full jitter, see https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        return random.uniform(0, self.backoff * 2**attempt)
+
+    def record(
+        self,
+        endpoint: str,
+        attempt: int,
+        seconds: float,
+        response: None | requests.Response,
+    ):
+        sent, received = 0, 0
+        if response is not None:
+            body = response.request.body
+            sent = len(body) if body is not None else 0
+            received = len(response.content)
+        with self.lock:
+            stats = self.stats.setdefault(endpoint, EndpointStats())
+            stats.requests += 1
+            stats.retries += attempt > 0
+            stats.seconds += seconds
+            stats.latencies.append(seconds)
+            stats.bytes_sent += sent
+            stats.bytes_received += received
+        profiling.count(f"http {endpoint}", seconds, sent + received)
+
+    def learn_full_page(self, size: int):
+        with self.lock:
+            self.full_page = max(size, self.full_page or 0)
+
+    def print_summary(self):
+        for endpoint, stats in sorted(self.stats.items()):
+            latencies = sorted(stats.latencies)
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[int(len(latencies) * 0.95)]
+            print(
+                f"{endpoint}: {stats.requests} requests, {stats.retries} retries, "
+                f"p50 {p50 * 1000:.0f}ms, p95 {p95 * 1000:.0f}ms, "
+                f"{stats.bytes_sent} bytes sent, {stats.bytes_received} bytes received"
+            )
+
+
+shared_clients: dict[tuple[str, str, int], MochiClient] = {}
+
+
+def shared_client(token: str, connections: int = 16) -> MochiClient:
+    """
+    the same client for the same token, url, and connections, in this process
+    so that a long running process, like 'cman daemon', keeps its connections open
+    """
+    key = (token, os.environ.get("cman_mochi_url", ""), connections)
+    if key not in shared_clients:
+        shared_clients[key] = MochiClient(token, connections=connections)
+    return shared_clients[key]
 
 
 def model_config():
@@ -57,101 +244,132 @@ class Card(BaseModel):
     template_id: None | str = None
 
 
-def iterate_paged_docs(auth: HTTPBasicAuth, url: str, params: dict) -> Iterator[dict]:
+def iterate_paged_docs(
+    client: MochiClient,
+    at: str,
+    endpoint: str,
+    params: dict,
+    short_page_ends: bool = False,
+) -> Iterator[dict]:
+    """
+    the next page is fetched while the caller works through the current one
+    with short_page_ends, a page shorter than a known full page is the last one
+    """
     limit = 100
-    page_params = {"limit": limit}
-    while True:
-        response = requests.get(url, params={**params, **page_params}, auth=auth)
-        assert response.status_code == 200, response.text
+
+    def fetch(bookmark: None | str) -> tuple[list[dict], str]:
+        page_params: dict = {"limit": limit}
+        if bookmark is not None:
+            page_params["bookmark"] = bookmark
+        response = client.request("GET", at, endpoint, params={**params, **page_params})
         response_json = response.json()
-        bookmark = response_json["bookmark"]
-        docs = response_json["docs"]
-        yield from docs
-        # TODO len(docs) < limit would be best
-        # but the api doesnt complain if you use a too high limit
-        # so len(docs) == 0 is the only robust way I can see, but uses an extra request
-        if len(docs) == 0:
-            break
-        page_params["bookmark"] = bookmark
-
-
-def raw_list_cards(auth: HTTPBasicAuth, deck_id: None | str = None) -> Iterator[dict]:
-    url = url_at("cards")
+        return response_json["docs"], response_json["bookmark"]
+
+    with ThreadPoolExecutor(1) as executor:
+        page = executor.submit(fetch, None)
+        previous = None
+        while True:
+            docs, bookmark = page.result()
+            if previous is not None and len(docs) > 0:
+                # NOTE the previous page was followed by more, so it was a full page
+                client.learn_full_page(previous)
+            if len(docs) == limit:
+                client.learn_full_page(limit)
+            # TODO len(docs) < limit would be best
+            # but the api doesnt complain if you use a too high limit
+            # so len(docs) == 0 is the only robust way I can see, but uses an extra request
+            # unless we know from earlier pages what a full page looks like
+            if len(docs) == 0:
+                break
+            full = client.full_page
+            if short_page_ends and full is not None and len(docs) < full:
+                yield from docs
+                break
+            page = executor.submit(fetch, bookmark)
+            previous = len(docs)
+            yield from docs
+
+
+def raw_list_cards(
+    client: MochiClient, deck_id: None | str = None, short_page_ends: bool = False
+) -> Iterator[dict]:
     params = {}
     if deck_id is not None:
         params["deck-id"] = deck_id
     # TODO now deal with tqdm higher up, where we might have some len() estimate
-    return iterate_paged_docs(auth, url, params)
+    return iterate_paged_docs(client, "cards", "GET cards", params, short_page_ends)
 
 
-def list_cards(auth: HTTPBasicAuth, deck_id: None | str = None) -> Iterator[Card]:
-    for doc in raw_list_cards(auth, deck_id):
+def list_cards(
+    client: MochiClient, deck_id: None | str = None, short_page_ends: bool = False
+) -> Iterator[Card]:
+    for doc in raw_list_cards(client, deck_id, short_page_ends):
         yield Card(**doc)
 
 
-def raw_create_card(auth: HTTPBasicAuth, deck_id: str, content: str) -> dict:
-    url = url_at("cards")
+def raw_create_card(client: MochiClient, deck_id: str, content: str) -> dict:
     body = {
         "deck-id": deck_id,
         "content": content,
     }
-    response = requests.post(url, json=body, auth=auth)
-    assert response.status_code == 200, response.text
+    response = client.request("POST", "cards", "POST cards", json=body)
     return response.json()
 
 
 def create_card(
-    auth: HTTPBasicAuth, deck_id: str, content: str, attachments: list[Attachment]
+    client: MochiClient, deck_id: str, content: str, attachments: list[Attachment]
 ) -> Card:
-    card = Card(**raw_create_card(auth, deck_id, content))
+    card = Card(**raw_create_card(client, deck_id, content))
     for attachment in attachments:
-        raw_update_attachment(auth, card.id, attachment)
+        raw_update_attachment(client, card.id, attachment)
     return card
 
 
-def raw_retrieve_card(auth: HTTPBasicAuth, card_id: str) -> dict:
-    url = url_at(f"cards/{card_id}")
-    response = requests.get(url, auth=auth)
-    assert response.status_code == 200, response.text
+def raw_retrieve_card(client: MochiClient, card_id: str) -> dict:
+    response = client.request("GET", f"cards/{card_id}", "GET cards/:id")
     return response.json()
 
 
-def retrieve_card(auth: HTTPBasicAuth, card_id: str) -> Card:
-    return Card(**raw_retrieve_card(auth, card_id))
+def retrieve_card(client: MochiClient, card_id: str) -> Card:
+    return Card(**raw_retrieve_card(client, card_id))
+
+
+def raw_retrieve_attachment(client: MochiClient, card_id: str, name: str) -> bytes:
+    response = client.request(
+        "GET",
+        f"cards/{card_id}/attachments/{name}",
+        "GET cards/:id/attachments/:name",
+    )
+    return response.content
 
 
-def raw_update_attachment(auth: HTTPBasicAuth, id: str, attachment: Attachment):
-    url = url_at(f"cards/{id}/attachments/{attachment.file_name}")
-    response = requests.post(url, files={"file": attachment.binary_data}, auth=auth)
-    assert response.status_code == 200, response.text
+def raw_update_attachment(client: MochiClient, id: str, attachment: Attachment):
+    client.request(
+        "POST",
+        f"cards/{id}/attachments/{attachment.file_name}",
+        "POST cards/:id/attachments/:name",
+        files={"file": attachment.binary_data},
+    )
 
 
-def raw_update_card(auth: HTTPBasicAuth, card: dict) -> dict:
-    url = url_at(f"cards/{card['id']}")
+def raw_update_card(client: MochiClient, card: dict) -> dict:
     # TODO I dont like this, how to control what's passed what not?
     # pydantic Model stuff is good for validation, but we probably still need to control what goes thru?
     # because in listing, a card has an id, when updating, the card id comes thru the url ...
     # so we cannot really make the Card Model the only thing, maybe to model_dump(include=...) explicitely?
-    card.pop("id")
-    response = requests.post(url, json=card, auth=auth)
-    assert response.status_code == 200, response.text
+    id = card.pop("id")
+    response = client.request("POST", f"cards/{id}", "POST cards/:id", json=card)
     return response.json()
 
 
 def update_card(
-    auth: HTTPBasicAuth, card: Card, attachments: Sequence[Attachment]
+    client: MochiClient, card: Card, attachments: Sequence[Attachment]
 ) -> Card:
     for attachment in attachments:
         # NOTE depending on changes, we might end up with unreferenced images for a card on the server
-        raw_update_attachment(auth, card.id, attachment)
-    return Card(**raw_update_card(auth, body_from_model(card)))
-
-
-def delete_card(auth: HTTPBasicAuth, card_id: str):
-    url = url_at(f"cards/{card_id}")
-    response = requests.delete(url, auth=auth)
-    assert response.status_code == 200, response.text
+        raw_update_attachment(client, card.id, attachment)
+    return Card(**raw_update_card(client, body_from_model(card)))
 
 
-def auth_from_token(token: str) -> HTTPBasicAuth:
-    return HTTPBasicAuth(token, "")
+def delete_card(client: MochiClient, card_id: str):
+    client.request("DELETE", f"cards/{card_id}", "DELETE cards/:id")
@@ -1,22 +1,150 @@
+"""
+backups of the configured decks, raw, as the api returns them
+decks are backed up concurrently, and streamed page by page into compressed json lines
+a manifest records counts and hashes, to check a backup later
+"""
+
+from __future__ import annotations
+
 import datetime
+import gzip
 import json
+import re
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
 from pathlib import Path
+from typing import IO, Literal
 
 import click
 from tqdm import tqdm
 
-from cman.api import auth_from_token, raw_list_cards
+from cman import profiling
+from cman.api import ApiError, MochiClient, raw_list_cards, raw_retrieve_attachment
+
+type Compression = Literal["gzip", "zstd"]
+
+# NOTE how attachments are referenced from the content, see cman.data.Images
+attachment_re = re.compile(r"@media/([^\s)\"']+)")
+
+
+def default_compression() -> Compression:
+    try:
+        import zstandard  # noqa: F401
+    except ImportError:
+        return "gzip"
+    return "zstd"
+
+
+def open_compressed(path: Path, compression: Compression) -> IO[bytes]:
+    match compression:
+        case "gzip":
+            return gzip.open(path, "wb")
+        case "zstd":
+            import zstandard
+
+            return zstandard.ZstdCompressor().stream_writer(path.open("wb"))
+
+
+def backup(
+    token: str,
+    decks: Mapping[str, str],  # deck name -> mochi deck id
+    out: Path,
+    compression: Compression,
+    attachments: bool = False,
+):
+    if out.exists():
+        click.confirm(f"Overwrite {out}?", abort=True)
+    out.mkdir(parents=True, exist_ok=True)
+
+    client = MochiClient(token)
+    progress = tqdm(desc="backup cards")
+
+    def f(deck: tuple[str, str]) -> dict:
+        name, id = deck
+        return backup_deck(client, out, name, id, compression, attachments, progress)
+
+    with progress, ThreadPoolExecutor(max(1, len(decks))) as executor:
+        entries = list(executor.map(f, decks.items()))
+
+    manifest = {
+        "date": datetime.date.today().isoformat(),
+        "compression": compression,
+        "decks": entries,
+    }
+    (out / "manifest.json").write_text(json.dumps(manifest, indent=4))
+
+
+def backup_deck(
+    client: MochiClient,
+    out: Path,
+    deck_name: str,
+    deck_id: str,
+    compression: Compression,
+    attachments: bool,
+    progress: tqdm,
+) -> dict:
+    """returns the entry for the manifest"""
+    path = out / f"deck-{deck_id}.jsonl.{'gz' if compression == 'gzip' else 'zst'}"
+    content_hash = sha256()
+    count = 0
+    names: list[tuple[str, str]] = []  # card id and attachment name
+    with (
+        profiling.span("backup deck", deck=deck_name),
+        open_compressed(path, compression) as f,
+    ):
+        for card in raw_list_cards(client, deck_id):
+            line = (json.dumps(card, sort_keys=True) + "\n").encode()
+            content_hash.update(line)
+            f.write(line)
+            count += 1
+            progress.update()
+            if attachments:
+                names.extend(
+                    (card["id"], name)
+                    for name in sorted(set(attachment_re.findall(card["content"])))
+                )
+
+    entry = {
+        "name": deck_name,
+        "id": deck_id,
+        "file": path.name,
+        "cards": count,
+        "sha256": file_hash(path),
+        # NOTE of the uncompressed json lines, it does not depend on the compression
+        "content_sha256": content_hash.hexdigest(),
+    }
+    if attachments:
+        entry["attachments"] = backup_attachments(client, out, names)
+    return entry
+
 
+def backup_attachments(
+    client: MochiClient, out: Path, names: list[tuple[str, str]]
+) -> list[dict]:
+    def f(name: tuple[str, str]) -> dict:
+        card_id, file_name = name
+        entry = {"card": card_id, "name": file_name}
+        try:
+            data = raw_retrieve_attachment(client, card_id, file_name)
+        except ApiError as e:
+            if e.status_code == 404:
+                return entry | {"missing": True}
+            raise
+        at = out / "attachments" / card_id / file_name
+        at.parent.mkdir(parents=True, exist_ok=True)
+        at.write_bytes(data)
+        return entry | {"bytes": len(data), "sha256": sha256(data).hexdigest()}
 
-def backup_deck(token: str, deck_name: str, deck_id: str):
-    date = datetime.date.today()
-    path = Path(f"backup-mochi-deck-{deck_id}-from-{date.isoformat()}.json")
-    if path.exists():
-        click.confirm(f"Overwrite {path}?", abort=True)
+    with ThreadPoolExecutor(8) as executor:
+        return list(
+            tqdm(executor.map(f, names), total=len(names), desc="backup attachments")
+        )
 
-    auth = auth_from_token(token)
-    cards = list(
-        tqdm(raw_list_cards(auth, deck_id), desc=f"list cards of deck {deck_name}")
-    )
 
-    path.write_text(json.dumps(cards, indent=4))
+def file_hash(path: Path) -> str:
+    hash = sha256()
+    with path.open("rb") as f:
+        while chunk := f.read(2**20):
+            hash.update(chunk)
+    return hash.hexdigest()
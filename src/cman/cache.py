@@ -0,0 +1,128 @@
+"""
+persistent content-addressed cache
+a key is a hash over everything that determines the value
+so there is no invalidation, only eviction when the cache grows too big
+"""
+
+from __future__ import annotations
+
+import os
+import pickle
+import threading
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+from typing import Any
+
+from cman.markdown import (
+    Engine,
+    Markdown,
+    mochi_format,
+    mochi_options,
+    pandoc_version,
+)
+
+
+def key_of(*parts: str | bytes) -> str:
+    hash = sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode()
+        # NOTE length prefix so that ("ab", "c") and ("a", "bc") differ
+        hash.update(len(part).to_bytes(8))
+        hash.update(part)
+    return hash.hexdigest()
+
+
+@dataclass
+class Cache:
+    folder: Path
+    max_bytes: int = 512 * 2**20
+
+    @classmethod
+    def default(cls):
+        match os.environ.get("XDG_CACHE_HOME"):
+            case None | "":
+                folder = Path.home() / ".cache" / "cman"
+            case str(path):
+                folder = Path(path) / "cman"
+        return cls(folder)
+
+    def path_of(self, key: str) -> Path:
+        return self.folder / key[:2] / key
+
+    def get(self, key: str) -> None | Any:
+        path = self.path_of(key)
+        try:
+            value = pickle.loads(path.read_bytes())
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+        # NOTE mtime doubles as last access time for the eviction in prune
+        path.touch()
+        return value
+
+    def put(self, key: str, value: Any):
+        path = self.path_of(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # NOTE write and rename, so that readers never see a partial file
+        # per process and thread, images are encoded on threads, see cman.data.encode_images
+        tmp = path.with_name(f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_bytes(pickle.dumps(value))
+        tmp.replace(path)
+
+    def prune(self):
+        """evict least recently used entries until we are below max_bytes"""
+        if not self.folder.exists():
+            return
+        entries = [(p, p.stat()) for p in self.folder.glob("*/*") if p.is_file()]
+        entries.sort(key=lambda e: e[1].st_mtime)
+        total = sum(s.st_size for _, s in entries)
+        for path, stat in entries:
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= stat.st_size
+
+
+def markdown_from_str(
+    cache: None | Cache, text: str, engine: Engine = Engine.pandoc
+) -> Markdown:
+    if cache is None:
+        return Markdown.from_str(text, engine)
+    key = key_of("markdown", engine.value, pandoc_version(), text)
+    match cache.get(key):
+        case Markdown() as markdown:
+            return markdown
+        case _:
+            markdown = Markdown.from_str(text, engine)
+            cache.put(key, markdown)
+            return markdown
+
+
+def markdown_from_path(
+    cache: None | Cache, path: Path, engine: Engine = Engine.pandoc
+) -> Markdown:
+    return markdown_from_str(cache, path.read_text(), engine)
+
+
+def as_mochi_md_str(
+    cache: None | Cache, markdown: Markdown, engine: Engine = Engine.pandoc
+) -> str:
+    if cache is None:
+        return markdown.as_mochi_md_str(engine)
+    # NOTE the repr of the ast is complete and stable, and includes rewritten image targets
+    key = key_of(
+        "mochi",
+        engine.value,
+        pandoc_version(),
+        mochi_format,
+        *mochi_options,
+        repr(markdown.body),
+    )
+    match cache.get(key):
+        case str(content):
+            return content
+        case _:
+            content = markdown.as_mochi_md_str(engine)
+            cache.put(key, content)
+            return content
@@ -1,10 +1,14 @@
 from __future__ import annotations
 
+from collections.abc import Collection
 from pathlib import Path
-from typing import Annotated, Never
+from typing import TYPE_CHECKING, Annotated, Never
 
 import typer
 
+if TYPE_CHECKING:
+    from cman.scope import Scope
+
 # NOTE minimize imports top level for a fast cli
 
 
@@ -35,41 +39,497 @@ app = typer.Typer(
 )
 
 
+@app.callback()
+def main(
+    ctx: typer.Context,
+    profile: Annotated[
+        None | Path,
+        typer.Option(
+            help="write a json summary of where the time went, and a chrome trace next to it"
+        ),
+    ] = None,
+):
+    if profile is None:
+        return
+
+    import sys
+
+    from cman import profiling
+
+    profiling.enable()
+
+    def write():
+        assert profiling.profiler is not None
+        trace = profiling.profiler.write(profile)
+        print(f"Profile in {profile}, trace in {trace}.", file=sys.stderr)
+
+    # NOTE also when the command fails or is aborted, that is when it's most interesting
+    ctx.call_on_close(write)
+
+
+PathsArgument = Annotated[
+    None | list[Path],
+    typer.Argument(help="only sync these files or folders, default everything"),
+]
+DeckOption = Annotated[
+    None | list[str], typer.Option(help="only sync this deck, can be repeated")
+]
+ChangedSinceOption = Annotated[
+    None | str,
+    typer.Option(
+        help="only sync files that changed since this git ref, including uncommitted"
+    ),
+]
+NoCacheOption = Annotated[
+    bool, typer.Option("--no-cache", help="parse and render without the cache")
+]
+JobsOption = Annotated[
+    None | int,
+    typer.Option("--jobs", "-j", help="processes to build cards, default all cores"),
+]
+ConnectionsOption = Annotated[
+    int, typer.Option(help="most api requests in flight when applying changes")
+]
+FastOption = Annotated[
+    bool,
+    typer.Option(
+        "--fast",
+        help="diff against the snapshot of what was pushed, instead of listing remote cards",
+    ),
+]
+SampleOption = Annotated[
+    int,
+    typer.Option(help="with --fast, how many random cards to check for remote changes"),
+]
+YesOption = Annotated[
+    bool, typer.Option("--yes", "-y", help="apply changes without asking")
+]
+
+
+def get_scope(
+    cards: Path,
+    decks: Collection[str],
+    paths: None | list[Path],
+    deck: None | list[str],
+    changed_since: None | str,
+) -> None | Scope:
+    from cman.scope import Scope
+
+    scope = Scope()
+    if paths:
+        try:
+            scope |= Scope.from_paths(cards, paths)
+        except ValueError:
+            abort(f"Not all paths are inside of {cards}.")
+    if deck:
+        if unknown := set(deck) - set(decks):
+            abort(f"Unknown decks {', '.join(sorted(unknown))}.")
+        scope |= Scope(folders={Path(d) for d in deck})
+    if changed_since is not None:
+        scope |= Scope.from_git(cards, changed_since)
+    scoped = bool(paths) or bool(deck) or changed_since is not None
+    return scope if scoped else None
+
+
 @app.command()
-def sync():
+def sync(
+    paths: PathsArgument = None,
+    deck: DeckOption = None,
+    changed_since: ChangedSinceOption = None,
+    no_cache: NoCacheOption = False,
+    jobs: JobsOption = None,
+    connections: ConnectionsOption = 8,
+    fast: FastOption = False,
+    sample: SampleOption = 20,
+    yes: YesOption = False,
+    resume: Annotated[
+        bool,
+        typer.Option(
+            "--resume",
+            help="continue the last sync that did not finish, without building and diffing again",
+        ),
+    ] = False,
+):
+    """plan and apply, see plan and apply to do it in two steps"""
+    import os
+
+    from cman.api import shared_client
+    from cman.cache import Cache
     from cman.config import Config, Credentials
+    from cman.markdown import Engine
     from cman.sync import sync
+    from cman.workers import start
+
+    if resume:
+        return apply_plan(connections, yes)
 
     base = get_base()
     config = Config.from_base(base)
     credentials = Credentials.from_base(base)
+    cache = None if no_cache else Cache.default()
+    cards = base / config.path
+    scope = get_scope(cards, config.decks.keys(), paths, deck, changed_since)
+
+    start(config.pandoc_workers)
+
+    sync(
+        shared_client(credentials.mochi.token, connections),
+        cards,
+        config.decks,
+        cache,
+        Engine(config.engine),
+        jobs or os.process_cpu_count() or 1,
+        connections,
+        fast,
+        sample,
+        scope,
+        yes,
+        config.images,
+    )
 
-    sync(credentials.mochi.token, base / config.path, config.decks)
+
+@app.command()
+def plan(
+    paths: PathsArgument = None,
+    deck: DeckOption = None,
+    changed_since: ChangedSinceOption = None,
+    no_cache: NoCacheOption = False,
+    jobs: JobsOption = None,
+    fast: FastOption = False,
+    sample: SampleOption = 20,
+    yes: Annotated[
+        bool, typer.Option("--yes", "-y", help="change meta without asking")
+    ] = False,
+):
+    """
+    what sync would do, written to .sync-plan in the cards, for apply
+    meta and the remote snapshot are updated, like sync does before it applies
+    """
+    import os
+
+    from cman import plan
+    from cman.api import shared_client
+    from cman.cache import Cache
+    from cman.config import Config, Credentials
+    from cman.markdown import Engine
+    from cman.sync import make_plan
+    from cman.workers import start
+
+    base = get_base()
+    config = Config.from_base(base)
+    credentials = Credentials.from_base(base)
+    cache = None if no_cache else Cache.default()
+    cards = base / config.path
+    scope = get_scope(cards, config.decks.keys(), paths, deck, changed_since)
+
+    start(config.pandoc_workers)
+
+    planned = make_plan(
+        shared_client(credentials.mochi.token),
+        cards,
+        config.decks,
+        cache,
+        Engine(config.engine),
+        jobs or os.process_cpu_count() or 1,
+        fast,
+        sample,
+        scope,
+        yes,
+        config.images,
+    )
+    if len(planned.operations) == 0:
+        plan.remove_plan(cards)
+        print("Nothing to do.")
+        return
+    plan.write_plan(cards, planned)
+    print(f"Planned {len(planned.operations)} operations, see 'cman apply'.")
+
+
+@app.command()
+def apply(connections: ConnectionsOption = 8, yes: YesOption = False):
+    """the operations of the plan that are not done yet, see plan"""
+    apply_plan(connections, yes)
+
+
+def apply_plan(connections: int, yes: bool):
+    import click
+
+    from cman import plan
+    from cman.api import shared_client
+    from cman.config import Config, Credentials
+    from cman.data import read_meta
+    from cman.sync import apply
+
+    base = get_base()
+    config = Config.from_base(base)
+    credentials = Credentials.from_base(base)
+    cards = base / config.path
+
+    planned = plan.read_plan(cards)
+    if planned is None:
+        abort("There is no plan to apply, see 'cman plan'.")
+    planned.print_summary(planned.remaining(read_meta(cards)))
+    if not yes:
+        click.confirm("Continue?", abort=True)
+
+    apply(
+        shared_client(credentials.mochi.token, connections), cards, planned, connections
+    )
+
+
+@app.command()
+def daemon():
+    """
+    serve commands from the editor, like show, rename, move, or sync -y of a card, without starting up
+    while it runs, cman sends these commands to it, set $cman_no_daemon to not do that
+    """
+    from cman.config import Config
+    from cman.daemon import is_running, serve
+
+    base = get_base()
+    config = Config.from_base(base)
+    if is_running(base):
+        abort(f"A daemon for {base} is already running.")
+
+    serve(base, config.pandoc_workers)
 
 
 @app.command()
 def preview():
     from cman.config import Config
     from cman.preview import main
+    from cman.workers import start
 
     base = get_base()
     config = Config.from_base(base)
+    start(config.pandoc_workers)
 
     main(base / config.path)
 
 
 @app.command()
-def backup():
-    """backup all cards of the configured decks, raw, as json"""
-    from cman.backup import backup_deck
+def render(
+    out: Annotated[Path, typer.Argument(help="folder for the html site")],
+    no_cache: Annotated[
+        bool, typer.Option("--no-cache", help="parse without the cache")
+    ] = False,
+    jobs: Annotated[
+        None | int,
+        typer.Option(
+            "--jobs", "-j", help="processes to render cards, default all cores"
+        ),
+    ] = None,
+):
+    """
+    render all cards in both directions to a static html site, with an index per deck
+    only cards whose markdown or images changed since the last render are rendered again
+    """
+    import os
+
+    from cman.cache import Cache
+    from cman.config import Config
+    from cman.markdown import Engine
+    from cman.render import render
+    from cman.workers import start
+
+    base = get_base()
+    config = Config.from_base(base)
+    cache = None if no_cache else Cache.default()
+    start(config.pandoc_workers)
+
+    render(
+        base / config.path,
+        config.decks.keys(),
+        out,
+        cache,
+        Engine(config.engine),
+        jobs or os.process_cpu_count() or 1,
+    )
+    print(f"See {out / 'index.html'}.")
+
+
+@app.command()
+def backup(
+    out: Annotated[
+        None | Path,
+        typer.Option(
+            help="folder for the backup, default is dated in the current folder"
+        ),
+    ] = None,
+    compression: Annotated[
+        None | str,
+        typer.Option(help="gzip or zstd, default is zstd if zstandard is installed"),
+    ] = None,
+    attachments: Annotated[
+        bool, typer.Option("--attachments", help="also download all attachments")
+    ] = False,
+):
+    """backup all cards of the configured decks, raw, as compressed json lines"""
+    import datetime
+
+    from cman.backup import backup, default_compression
+    from cman.config import Config, Credentials
+
+    base = get_base()
+    config = Config.from_base(base)
+    credentials = Credentials.from_base(base)
+
+    if out is None:
+        out = Path(f"backup-mochi-from-{datetime.date.today().isoformat()}")
+    match compression:
+        case None:
+            compression = default_compression()
+        case "gzip" | "zstd":
+            pass
+        case _:
+            abort(f"Unknown compression {compression}, use gzip or zstd.")
+
+    backup(credentials.mochi.token, config.decks, out, compression, attachments)
+
+
+snapshot_app = typer.Typer(
+    help="deduplicated snapshots of the configured decks",
+    no_args_is_help=True,
+    rich_markup_mode=None,
+)
+app.add_typer(snapshot_app, name="snapshot")
+
+StoreOption = Annotated[
+    None | Path,
+    typer.Option(
+        "--store", help="where snapshots are, default is snapshots in the base"
+    ),
+]
+
+
+def get_store(store: None | Path):
+    from cman.snapshots import Store
+
+    return Store(store or get_base() / "snapshots")
+
+
+@snapshot_app.command("take")
+def snapshot_take(
+    store: StoreOption = None,
+    attachments: Annotated[
+        bool, typer.Option("--attachments", help="also store all attachments")
+    ] = False,
+):
+    """store the current state of all configured decks, only changes take space"""
+    from cman.api import shared_client
     from cman.config import Config, Credentials
+    from cman.snapshots import take
 
     base = get_base()
     config = Config.from_base(base)
     credentials = Credentials.from_base(base)
+    client = shared_client(credentials.mochi.token)
 
-    for deck_name, deck_id in config.decks.items():
-        backup_deck(credentials.mochi.token, deck_name, deck_id)
+    name = take(get_store(store), client, config.decks, attachments)
+    print(f"Took snapshot {name}.")
+
+
+@snapshot_app.command("list")
+def snapshot_list(store: StoreOption = None):
+    snapshots = get_store(store)
+    for name in snapshots.names():
+        snapshot = snapshots.read(name)
+        decks = ", ".join(
+            f"{snapshot.names.get(id, id)} {len(cards)}"
+            for id, cards in sorted(snapshot.decks.items())
+        )
+        print(f"{name}: {decks}")
+
+
+@snapshot_app.command("diff")
+def snapshot_diff(
+    old: str,
+    new: Annotated[None | str, typer.Argument(help="default is the latest")] = None,
+    store: StoreOption = None,
+):
+    from cman.snapshots import SnapshotDiff
+
+    snapshots = get_store(store)
+    names = snapshots.names()
+    for name in [old, new]:
+        if name is not None and name not in names:
+            abort(f"There is no snapshot {name}.")
+    a = snapshots.read(old)
+    b = snapshots.read(new or names[-1])
+    SnapshotDiff.from_snapshots(a, b).print_summary(a.names | b.names)
+
+
+@snapshot_app.command("prune")
+def snapshot_prune(
+    last: Annotated[int, typer.Option(help="keep the last snapshots")] = 7,
+    daily: Annotated[int, typer.Option(help="keep one for each of the last days")] = 14,
+    weekly: Annotated[
+        int, typer.Option(help="keep one for each of the last weeks")
+    ] = 12,
+    store: StoreOption = None,
+):
+    """remove snapshots outside of the retention, and the objects only they used"""
+    import click
+
+    from cman.snapshots import retained
+
+    snapshots = get_store(store)
+    names = snapshots.names()
+    keep = retained(names, last, daily, weekly)
+    print(f"Keeping {len(keep)} and removing {len(names) - len(keep)} snapshots.")
+    if len(keep) < len(names):
+        click.confirm("Continue?", abort=True)
+        _, objects = snapshots.prune(keep)
+        print(f"Removed {objects} objects.")
+
+
+@snapshot_app.command("restore")
+def snapshot_restore(
+    name: str,
+    deck: Annotated[
+        None | list[str], typer.Option(help="only this deck, by name or id")
+    ] = None,
+    into: Annotated[
+        None | str,
+        typer.Option(help="deck id to create the cards in, default is the original"),
+    ] = None,
+    store: StoreOption = None,
+):
+    """
+    re-create the cards of a snapshot as new cards, with their attachments
+    it does not touch existing cards, and the new cards have new ids
+    """
+    import click
+
+    from cman.api import shared_client
+    from cman.config import Credentials
+    from cman.executor import Report
+    from cman.snapshots import restore
+
+    base = get_base()
+    credentials = Credentials.from_base(base)
+    snapshots = get_store(store)
+    if name not in snapshots.names():
+        abort(f"There is no snapshot {name}.")
+    snapshot = snapshots.read(name)
+
+    deck_ids = [
+        id
+        for id in snapshot.decks
+        if deck is None or id in deck or snapshot.names.get(id) in deck
+    ]
+    if len(deck_ids) == 0:
+        abort("No matching decks in the snapshot.")
+    count = sum(len(snapshot.decks[id]) for id in deck_ids)
+    print(f"Restoring {count} cards from {name}.")
+    click.confirm("Continue?", abort=True)
+
+    client = shared_client(credentials.mochi.token)
+    report = Report()
+    restore(snapshots, client, snapshot, {id: into or id for id in deck_ids}, report)
+    report.print_summary()
+    if len(report.failures) > 0:
+        raise typer.Abort()
 
 
 @app.command()
@@ -144,17 +604,185 @@ def show(path: Path):
         print(f"image at {path}")
 
 
+@app.command()
+def compare_engines():
+    """
+    compare the python markdown engine against pandoc on all configured cards
+    reports files where they differ, and how many files fall back to pandoc
+    """
+    from cman import minimd
+    from cman.config import Config
+    from cman.data import Images, read_markdowns
+
+    base = get_base()
+    config = Config.from_base(base)
+    path = base / config.path
+
+    fallbacks = 0
+    mismatches = 0
+    for at, md in read_markdowns(path, config.decks.keys()).items():
+        body = minimd.read((path / at).read_text())
+        if body is None:
+            fallbacks += 1
+        elif body != md.body:
+            mismatches += 1
+            print(f"{at} reads differently")
+
+        md = md.with_rewritten_images(Images.from_base(path / at.parent).collect)
+        variants = [md.maybe_prompted()]
+        if md.has_reverse_prompt():
+            variants.append(md.reversed().maybe_prompted())
+        for variant in variants:
+            content = minimd.write(variant.body)
+            if content is None:
+                fallbacks += 1
+            elif content != variant.as_mochi_md_str():
+                mismatches += 1
+                print(f"{at} writes differently")
+
+    print(f"{fallbacks} fallbacks to pandoc, {mismatches} mismatches")
+    if mismatches > 0:
+        abort("The python engine does not match pandoc.")
+
+
+@app.command()
+def images(
+    no_cache: NoCacheOption = False,
+    jobs: Annotated[
+        None | int,
+        typer.Option(
+            "--jobs", "-j", help="threads to encode images, default all cores"
+        ),
+    ] = None,
+):
+    """
+    bytes of all images as encoded with the configured image options, per deck
+    against full colour png, what cman did before there were options, nothing is uploaded
+    """
+    import os
+
+    from cman.cache import Cache
+    from cman.config import Config
+    from cman.data import encode_image, encode_images, read_markdowns
+    from cman.images import ImageOptions
+    from cman.markdown import Engine
+    from cman.workers import start
+
+    base = get_base()
+    config = Config.from_base(base)
+    cache = None if no_cache else Cache.default()
+    cards = base / config.path
+    jobs = jobs or os.process_cpu_count() or 1
+    start(config.pandoc_workers)
+
+    markdowns = read_markdowns(
+        cards, config.decks.keys(), cache, Engine(config.engine), jobs
+    )
+    paths: dict[str, set[Path]] = {deck: set() for deck in config.decks}
+    for at, md in markdowns.items():
+        for image in md.get_image_paths():
+            path = (cards / at.parent / image).absolute()
+            if path.exists():
+                paths[at.parts[0]].add(path)
+
+    legacy = ImageOptions()
+    encode_images(
+        cache,
+        {
+            (path, options)
+            for deck, deck_paths in paths.items()
+            for path in deck_paths
+            for options in [legacy, config.image_options(deck)]
+        },
+        jobs,
+    )
+
+    total_before, total_after = 0, 0
+    for deck, deck_paths in sorted(paths.items()):
+        options = config.image_options(deck)
+        before = sum(len(encode_image(cache, p, legacy)[0]) for p in deck_paths)
+        after = sum(len(encode_image(cache, p, options)[0]) for p in deck_paths)
+        total_before += before
+        total_after += after
+        print(
+            f"{deck}: {len(deck_paths)} images, {before / 1e6:.2f}MB as png, "
+            f"{after / 1e6:.2f}MB as configured, {options.format}"
+        )
+    saved = total_before - total_after
+    print(
+        f"{saved / 1e6:.2f}MB saved of {total_before / 1e6:.2f}MB, "
+        f"{100 * saved / max(1, total_before):.0f}%"
+    )
+
+
 @app.command()
 def fetch(card_id: str):
     from pprint import pp
 
-    from cman.api import auth_from_token, raw_retrieve_card
-    from cman.config import Credentials
+    from cman.api import raw_retrieve_card, shared_client
+    from cman.config import Config, Credentials
+    from cman.data import find_card
 
     base = get_base()
+    config = Config.from_base(base)
     credentials = Credentials.from_base(base)
-    auth = auth_from_token(credentials.mochi.token)
+    client = shared_client(credentials.mochi.token)
 
-    card = raw_retrieve_card(auth, card_id)
+    card = raw_retrieve_card(client, card_id)
 
     pp(card)
+
+    match find_card(base / config.path, card_id):
+        case None:
+            print("Not in meta.")
+        case (path, direction):
+            print(f"{direction.value} of {path}")
+
+
+@app.command()
+def which(card_id: str):
+    """which file is this card"""
+    from cman.config import Config
+    from cman.data import find_card
+
+    base = get_base()
+    config = Config.from_base(base)
+
+    match find_card(base / config.path, card_id):
+        case None:
+            abort(f"Card {card_id} is not in meta.")
+        case (path, direction):
+            print(f"{direction.value} of {base / config.path / path}")
+
+
+@app.command()
+def state(to: Annotated[str, typer.Argument(help="json or sqlite")]):
+    """
+    move meta and the remote snapshot between meta.json and remote.json, and state.sqlite
+    json is nice for diffs in git, sqlite has indexed lookups and cheap partial updates
+    """
+    from cman import store
+    from cman.config import Config
+    from cman.data import read_meta, read_remote, write_meta, write_remote
+
+    base = get_base()
+    config = Config.from_base(base)
+    path = base / config.path
+
+    meta, remote = read_meta(path), read_remote(path)
+    match to, store.exists(path):
+        case "sqlite", False:
+            store.write_meta(path, meta)
+            store.write_remote(path, remote)
+            for name in ["meta.json", "meta.journal", "remote.json", "remote.journal"]:
+                (path / name).unlink(missing_ok=True)
+        case "json", True:
+            # NOTE keep the store until the json is complete
+            old = store.path_of(path).rename(path / "state.sqlite.old")
+            write_meta(path, meta)
+            write_remote(path, remote)
+            old.unlink()
+        case "sqlite" | "json", _:
+            print(f"State is already in {to}.")
+        case _:
+            abort(f"Unknown state format {to}, use json or sqlite.")
@@ -0,0 +1,87 @@
+"""
+the entry point of the cman command, it sends commands to 'cman daemon' when one runs for $cman_base
+only commands that are typically run from the editor go to the daemon, and only if they cannot prompt
+everything else, and everything when there is no daemon, runs in this process as before
+set $cman_no_daemon to never use the daemon
+NOTE only the standard library here, the point is to start fast
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import socket
+import sys
+
+# NOTE sync asks before it changes anything, so it only goes to the daemon with --yes
+forwarded = {"show", "rename", "move", "which", "fetch"}
+
+
+def socket_path(base: str | os.PathLike) -> str:
+    """one socket per data folder, in the runtime dir of the user"""
+    # NOTE os.path and not pathlib, it's faster to import
+    key = hashlib.sha256(os.path.realpath(base).encode()).hexdigest()[:16]
+    match os.environ.get("XDG_RUNTIME_DIR"):
+        case None:
+            tmp = os.environ.get("TMPDIR", "/tmp")
+            runtime = os.path.join(tmp, f"cman-{os.getuid()}")
+        case str(path):
+            runtime = os.path.join(path, "cman")
+    return os.path.join(runtime, f"{key}.sock")
+
+
+def is_forwarded(args: list[str]) -> bool:
+    match args:
+        case [command, *_] if command in forwarded:
+            return True
+        case ["sync", *rest]:
+            return "--yes" in rest or "-y" in rest
+        case _:
+            return False
+
+
+def forward(base: str, args: list[str]) -> None | int:
+    """run args in the daemon, with output streamed here, None if there is no daemon"""
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path(base))
+    except OSError:
+        connection.close()
+        return None
+    request = {"args": args, "cwd": os.getcwd(), "env": dict(os.environ)}
+    with connection, connection.makefile("rwb") as stream:
+        stream.write(json.dumps(request).encode() + b"\n")
+        stream.flush()
+        for line in stream:
+            match json.loads(line):
+                case {"stdout": str(text)}:
+                    sys.stdout.write(text)
+                    sys.stdout.flush()
+                case {"stderr": str(text)}:
+                    sys.stderr.write(text)
+                    sys.stderr.flush()
+                case {"code": int(code)}:
+                    return code
+    print("The daemon went away, run the command again.", file=sys.stderr)
+    return 1
+
+
+def main():
+    args = sys.argv[1:]
+    base = os.environ.get("cman_base")
+    if base is not None and "cman_no_daemon" not in os.environ and is_forwarded(args):
+        # NOTE the daemon renames, the editor has to run here, in the terminal
+        edit = args[0] == "rename" and ("-e" in args or "--edit" in args)
+        if edit:
+            args = [a for a in args if a not in ["-e", "--edit"]]
+        code = forward(base, args)
+        if code is not None:
+            if edit and code == 0:
+                source, name = [a for a in args[1:] if not a.startswith("-")][:2]
+                os.execvp("nvim", ["nvim", os.path.join(os.path.dirname(source), name)])
+            sys.exit(code)
+
+    from cman.cli import app
+
+    app()
@@ -1,13 +1,19 @@
 from __future__ import annotations
 
-from dataclasses import dataclass
+import tomllib
+from dataclasses import dataclass, field, replace
 from pathlib import Path
+from typing import Any, Literal
 
-from serde import serde
-from serde.toml import from_toml
+from cman.images import ImageOptions
+
+# NOTE parsed by hand, every command reads the config, and pyserde takes longer to import than the rest
+
+
+class ConfigError(Exception):
+    pass
 
 
-@serde
 @dataclass
 class Config:
     # where the cards are
@@ -19,22 +25,107 @@ class Config:
     # NOTE only folder that are mentioned here are synced
     decks: dict[str, str]
 
+    # how to read and write markdown, see cman.markdown.Engine
+    engine: Literal["pandoc", "python"] = "pandoc"
+
+    # how many long-lived pandoc processes to keep, see cman.workers
+    # 0 starts a new pandoc process for every conversion
+    pandoc_workers: int = 0
+
+    # how images are encoded, per deck, see cman.images
+    # in the config, [images] is for all decks, and [images.decks.<deck>] overrides it for one
+    images: dict[str, ImageOptions] = field(default_factory=dict)
+
+    def image_options(self, deck: str) -> ImageOptions:
+        return self.images.get(deck, ImageOptions())
+
     @classmethod
     def from_base(cls, base: Path):
-        return from_toml(cls, (base / "config.toml").read_text())
+        at = base / "config.toml"
+        match tomllib.loads(at.read_text()):
+            case {"path": str(path), "decks": dict(decks), **rest} if all(
+                isinstance(id, str) for id in decks.values()
+            ):
+                pass
+            case _:
+                raise ConfigError(f"{at} needs a path, and decks that map to ids.")
+        match rest:
+            case {"engine": "pandoc" | "python" as engine}:
+                pass
+            case {"engine": engine}:
+                raise ConfigError(f"{at} has an unknown engine {engine}.")
+            case _:
+                engine = "pandoc"
+        match rest.get("pandoc_workers", 0):
+            case int(pandoc_workers) if pandoc_workers >= 0:
+                pass
+            case pandoc_workers:
+                raise ConfigError(f"{at} has invalid pandoc_workers {pandoc_workers}.")
+        match rest.get("images", {}):
+            case dict(images):
+                pass
+            case images:
+                raise ConfigError(f"{at} has invalid images {images}.")
+        match images.pop("decks", {}):
+            case dict(overrides) if all(
+                isinstance(o, dict) for o in overrides.values()
+            ):
+                pass
+            case overrides:
+                raise ConfigError(f"{at} has invalid images.decks {overrides}.")
+        if unknown := set(overrides) - set(decks):
+            raise ConfigError(
+                f"{at} has images for unknown decks {', '.join(sorted(unknown))}."
+            )
+        default = image_options_from(at, images, ImageOptions())
+        images = {
+            deck: image_options_from(at, overrides.get(deck, {}), default)
+            for deck in decks
+        }
+        return cls(Path(path), decks, engine, pandoc_workers, images)
+
+
+def image_options_from(
+    at: Path, raw: dict[str, Any], options: ImageOptions
+) -> ImageOptions:
+    """options with the ones in raw replaced"""
+    for name, value in raw.items():
+        # NOTE bools are ints too
+        match name, value:
+            case "format", "png" | "jpeg" | "webp" | "auto":
+                pass
+            case "optimize" | "fast_downscale", bool():
+                pass
+            case _, bool():
+                raise ConfigError(f"{at} has an invalid image option {name} = {value}.")
+            case "max_width", int() if value > 0:
+                pass
+            case "colors", int() if 0 <= value <= 256:
+                pass
+            case "quality", int() if 1 <= value <= 95:
+                pass
+            case "max_bytes", int() if value >= 0:
+                pass
+            case _:
+                raise ConfigError(f"{at} has an invalid image option {name} = {value}.")
+        options = replace(options, **{name: value})
+    return options
 
 
-@serde
 @dataclass
 class Mochi:
     token: str
 
 
-@serde
 @dataclass
 class Credentials:
     mochi: Mochi
 
     @classmethod
     def from_base(cls, base: Path):
-        return from_toml(cls, (base / "credentials.toml").read_text())
+        at = base / "credentials.toml"
+        match tomllib.loads(at.read_text()):
+            case {"mochi": {"token": str(token)}}:
+                return cls(Mochi(token))
+            case _:
+                raise ConfigError(f"{at} needs a mochi token.")
@@ -0,0 +1,132 @@
+"""
+a long running process that runs cman commands for cman.client, see 'cman daemon'
+everything is imported once, pandoc workers and http connections stay open between commands
+commands run one at a time, in the working directory and environment of the client
+their output is streamed back to the client, as json lines
+NOTE it runs the code it started with, restart it after changing cman
+"""
+
+from __future__ import annotations
+
+import io
+import json
+import os
+import signal
+import socket
+import socketserver
+import sys
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from pathlib import Path
+from threading import Lock
+
+from cman.client import socket_path
+
+
+class Stream(io.TextIOBase):
+    """a text file that sends what is written to the client, as stdout or stderr"""
+
+    def __init__(self, name: str, send):
+        self.name = name
+        self.send = send
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        if len(text) > 0:
+            self.send({self.name: text})
+        return len(text)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        lock = Lock()
+
+        def send(message: dict):
+            # NOTE commands print from threads, like tqdm in sync
+            with lock:
+                self.wfile.write(json.dumps(message).encode() + b"\n")
+                self.wfile.flush()
+
+        try:
+            code = run(request["args"], request["cwd"], request["env"], send)
+            send({"code": code})
+        except BrokenPipeError:
+            # NOTE the client went away, like with ctrl-c, there is no one to tell
+            pass
+
+
+def run(args: list[str], cwd: str, env: dict[str, str], send) -> int:
+    """the command, as if cman was called with args in cwd and env, returns the exit code"""
+    from cman.cli import app
+
+    before = (os.getcwd(), dict(os.environ))
+    os.chdir(cwd)
+    os.environ.clear()
+    os.environ.update(env)
+    stdout, stderr = Stream("stdout", send), Stream("stderr", send)
+    try:
+        # NOTE a command that asks for input gets none, and aborts, the client only forwards ones that don't
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            sys.stdin = io.StringIO()
+            try:
+                app(args, prog_name="cman")
+            except SystemExit as e:
+                match e.code:
+                    case None:
+                        return 0
+                    case int(code):
+                        return code
+                    case message:
+                        print(message, file=sys.stderr)
+                        return 1
+            except Exception:
+                traceback.print_exc()
+                return 1
+            return 0
+    finally:
+        sys.stdin = sys.__stdin__
+        os.chdir(before[0])
+        os.environ.clear()
+        os.environ.update(before[1])
+
+
+def is_running(base: Path) -> bool:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with connection:
+        try:
+            connection.connect(socket_path(base))
+        except OSError:
+            return False
+    return True
+
+
+def serve(base: Path, pandoc_workers: int):
+    """serve until interrupted, check is_running first, there is one daemon per base"""
+    from cman import cli, data, markdown, sync  # noqa: F401
+    from cman.markdown import pandoc_types
+    from cman.workers import start
+
+    pandoc_types()
+    start(max(1, pandoc_workers))
+
+    path = Path(socket_path(base))
+    path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    # NOTE left behind by a daemon that was killed
+    path.unlink(missing_ok=True)
+
+    # NOTE also when started in the background, where SIGINT is ignored, or stopped with kill
+    # so that the socket is removed
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    with socketserver.UnixStreamServer(str(path), Handler) as server:
+        path.chmod(0o600)
+        print(f"Serving {base} at {path}.", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            path.unlink(missing_ok=True)
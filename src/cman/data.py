@@ -1,21 +1,31 @@
 from __future__ import annotations
 
+import json
+import os
 import sys
-from collections.abc import Set
-from dataclasses import dataclass
+import time
+from collections.abc import Callable, Iterator, Mapping, Set
+from contextlib import suppress
+from dataclasses import asdict, dataclass, field
+from functools import partial
 from hashlib import sha256
-from io import BytesIO
 from pathlib import Path
 from shutil import copyfile
+from typing import TYPE_CHECKING, Any, assert_never
 
 import typer
-from PIL import Image
-from serde import serde
-from serde.json import from_json, to_json
-from tqdm import tqdm
 
-from cman.api import Attachment
-from cman.markdown import Direction, Markdown
+from cman import profiling, workers
+from cman.cache import Cache, as_mochi_md_str, key_of, markdown_from_path
+from cman.images import ImageOptions
+from cman.markdown import Direction, Engine, Markdown
+from cman.scope import Scope
+
+# NOTE heavy imports like pillow, tqdm, multiprocessing and the api are deferred to where they are needed
+# because light cli commands like rename and which import this too
+if TYPE_CHECKING:
+    from cman import api
+    from cman.api import Attachment
 
 
 # TODO same name as api.Card ... can we have a better name here?
@@ -28,7 +38,7 @@ class Card:
     direction: Direction
 
 
-@serde
+@dataclass
 class Meta:
     forward: None | str
     backward: None | str
@@ -52,33 +62,189 @@ class Meta:
                 assert False
 
 
-def read_markdowns(base: Path, decks: Set[str]) -> dict[Path, Markdown]:
+def read_markdowns(
+    base: Path,
+    decks: Set[str],
+    cache: None | Cache = None,
+    engine: Engine = Engine.pandoc,
+    jobs: int = 1,
+    scope: None | Scope = None,
+) -> dict[Path, Markdown]:
     """return paths are relative to base"""
-    paths = [path for deck in decks for path in (base / deck).rglob("*.md")]
-    return {
-        path.relative_to(base): Markdown.from_path(path)
-        for path in tqdm(paths, desc="read markdowns")
-    }
+    if scope is None:
+        paths = [(path,) for deck in decks for path in (base / deck).rglob("*.md")]
+    else:
+        paths = [(base / path,) for path in scope.markdown_paths(base, decks)]
+    f = partial(markdown_from_path, cache, engine=engine)
+    markdowns = map_parallel(f, paths, jobs, "read markdowns")
+    return {path.relative_to(base): md for (path,), md in zip(paths, markdowns)}
 
 
 def read_meta(base: Path) -> dict[Path, Meta]:
-    at = base / "meta.json"
-    if not at.exists():
-        return {}
-    meta_str = from_json(dict[str, Meta], at.read_text())
-    meta = {Path(p): m for p, m in meta_str.items()}
-    return meta
+    """includes changes that are still in the journal, see append_meta"""
+    # NOTE cman.store imports from here
+    from cman import store
+
+    if store.exists(base):
+        return store.read_meta(base)
+    raw = read_journaled(base / "meta.json", base / "meta.journal")
+    return {Path(p): Meta(**m) for p, m in raw.items()}
 
 
 def write_meta(base: Path, meta: dict[Path, Meta]):
+    from cman import store
+
+    if store.exists(base):
+        return store.write_meta(base, meta)
     # NOTE we sort it so that it's a bit more stable in a potential git diff
-    meta_str = {str(p): m for p, m in sorted(meta.items())}
-    (base / "meta.json").write_text(to_json(meta_str, indent=4))
+    meta_str = {str(p): asdict(m) for p, m in sorted(meta.items())}
+    write_compacted(base / "meta.json", base / "meta.journal", as_json(meta_str))
+
+
+def append_meta(base: Path, changes: dict[Path, Meta]):
+    """cheaper than write_meta for a few changes, compacted by the next write_meta"""
+    from cman import store
+
+    if store.exists(base):
+        return store.append_meta(base, changes)
+    append_journal(
+        base / "meta.journal", {str(p): asdict(m) for p, m in changes.items()}
+    )
+
+
+def find_card(base: Path, card_id: str) -> None | tuple[Path, Direction]:
+    """which file, and which direction of it, is this card"""
+    from cman import store
+
+    if store.exists(base):
+        return store.find_card(base, card_id)
+    for path, meta in read_meta(base).items():
+        for direction in Direction:
+            if meta.get_by_direction(direction) == card_id:
+                return path, direction
+    return None
+
+
+def read_journaled(at: Path, journal: Path) -> dict[str, Any]:
+    """the raw json dict at, with the changes in journal replayed"""
+    raw = json.loads(at.read_text()) if at.exists() else {}
+    if not journal.exists():
+        return raw
+    for line in journal.read_text().splitlines():
+        try:
+            change = json.loads(line)
+        except json.JSONDecodeError:
+            # NOTE only the last line can be partial, from a crash while appending
+            break
+        match change:
+            case {"key": str(key), "value": None}:
+                raw.pop(key, None)
+            case {"key": str(key), "value": value}:
+                raw[key] = value
+            case _:
+                assert False, change
+    return raw
+
+
+def append_journal(journal: Path, changes: dict[str, Any]):
+    """one json line per change, a value of None removes the key"""
+    if len(changes) == 0:
+        return
+    with journal.open("a") as f:
+        for key, value in changes.items():
+            f.write(json.dumps({"key": key, "value": value}) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def as_json(raw: dict[str, Any]) -> str:
+    # NOTE the same format pyserde wrote before, so that files dont change
+    return json.dumps(raw, indent=4, separators=(",", ":"))
+
+
+def write_compacted(at: Path, journal: Path, text: str):
+    """write the whole state, only then the journal is obsolete"""
+    # NOTE write and rename, so that there is always a complete file
+    tmp = at.with_name(f"{at.name}.tmp")
+    tmp.write_text(text)
+    tmp.replace(at)
+    journal.unlink(missing_ok=True)
+
+
+@dataclass
+class Remote:
+    """
+    what we know the remote has for a card, from what we pushed or last listed
+    this is a snapshot that lets us diff without listing all remote cards
+    """
+
+    # names of the attachments that were uploaded
+    attachments: list[str]
+    deck_id: None | str = None
+    # see content_hash()
+    content_hash: None | str = None
+
+    def is_complete(self) -> bool:
+        return self.deck_id is not None and self.content_hash is not None
+
+
+def content_hash(content: str) -> str:
+    return sha256(content.encode()).hexdigest()
+
+
+def read_remote(base: Path) -> dict[str, Remote]:
+    """includes changes that are still in the journal, see append_remote"""
+    from cman import store
+
+    if store.exists(base):
+        return store.read_remote(base)
+    raw = read_journaled(base / "remote.json", base / "remote.journal")
+    return {id: Remote(**r) for id, r in raw.items()}
+
+
+def write_remote(base: Path, remote: dict[str, Remote]):
+    from cman import store
+
+    if store.exists(base):
+        return store.write_remote(base, remote)
+    write_compacted(
+        base / "remote.json",
+        base / "remote.journal",
+        as_json({id: asdict(r) for id, r in sorted(remote.items())}),
+    )
+
+
+def append_remote(base: Path, changes: dict[str, None | Remote]):
+    """like append_meta, None means the card is gone"""
+    from cman import store
+
+    if store.exists(base):
+        return store.append_remote(base, changes)
+    append_journal(
+        base / "remote.journal",
+        {id: None if r is None else asdict(r) for id, r in changes.items()},
+    )
+
+
+def snapshot_from_listing(
+    cards: dict[str, api.Card], snapshot: dict[str, Remote]
+) -> dict[str, Remote]:
+    """the listing is the truth, but it does not say which attachments a card has"""
+    return {
+        id: Remote(
+            attachments=snapshot.get(id, Remote([])).attachments,
+            deck_id=card.deck_id,
+            content_hash=content_hash(card.content),
+        )
+        for id, card in cards.items()
+    }
 
 
 def get_synced_meta(
     markdowns: dict[Path, Markdown], meta: dict[Path, Meta]
 ) -> dict[Path, Meta]:
+    from tqdm import tqdm
+
     def f(path: Path, markdown: Markdown) -> Meta:
         if path not in meta:
             return Meta(None, None)
@@ -125,43 +291,72 @@ class MetaDiff:
         return len(self.changes)
 
 
-def get_cards(
-    base: Path, markdowns: dict[Path, Markdown], meta: dict[Path, Meta]
-) -> tuple[dict[str, Card], list[Card]]:
-    existing_cards: dict[str, Card] = dict()
-    new_cards: list[Card] = []
-
-    for path, markdown in tqdm(markdowns.items(), desc="make cards"):
-        images = Images.from_base(base / path.parent)
-        markdown = markdown.with_rewritten_images(images.collect)
-
-        card = Card(
-            content=markdown.maybe_prompted().as_mochi_md_str(),
+def make_cards(
+    base: Path,
+    cache: None | Cache,
+    engine: Engine,
+    image_options: Mapping[str, ImageOptions],
+    path: Path,
+    markdown: Markdown,
+) -> list[Card]:
+    """the forward card, and the backward card if there is a reverse prompt"""
+    options = image_options.get(path.parts[0], ImageOptions())
+    images = Images.from_base(base / path.parent, cache, options)
+    markdown = markdown.with_rewritten_images(images.collect)
+
+    directions = [Direction.forward]
+    if markdown.has_reverse_prompt():
+        directions.append(Direction.backward)
+
+    return [
+        Card(
+            content=as_mochi_md_str(
+                cache, markdown.oriented(direction).maybe_prompted(), engine
+            ),
             deck_name=path.parts[0],
             attachments=images.as_api_attachments(),
             path=path,
-            direction=Direction.forward,
+            direction=direction,
         )
+        for direction in directions
+    ]
 
-        match meta.get(path, Meta(None, None)).forward:
-            case None:
-                new_cards.append(card)
-            case str(card_id):
-                assert card_id not in existing_cards, card_id
-                existing_cards[card_id] = card
-            case _ as never:
-                assert_never(never)
-
-        if markdown.has_reverse_prompt():
-            card = Card(
-                content=markdown.reversed().maybe_prompted().as_mochi_md_str(),
-                deck_name=path.parts[0],
-                attachments=images.as_api_attachments(),
-                path=path,
-                direction=Direction.backward,
-            )
 
-            match meta.get(path, Meta(None, None)).backward:
+def get_cards(
+    base: Path,
+    markdowns: dict[Path, Markdown],
+    meta: dict[Path, Meta],
+    cache: None | Cache = None,
+    engine: Engine = Engine.pandoc,
+    jobs: int = 1,
+    image_options: None | Mapping[str, ImageOptions] = None,
+) -> tuple[dict[str, Card], list[Card]]:
+    """image_options are per deck name, the default for decks that are not in there"""
+    existing_cards: dict[str, Card] = dict()
+    new_cards: list[Card] = []
+    image_options = image_options or {}
+
+    # NOTE worker processes see what is encoded up front through the cache only
+    if cache is not None or jobs == 1:
+        encode_images(
+            cache,
+            {
+                (
+                    (base / path.parent / image).absolute(),
+                    image_options.get(path.parts[0], ImageOptions()),
+                )
+                for path, markdown in markdowns.items()
+                for image in markdown.get_image_paths()
+            },
+            jobs,
+        )
+
+    f = partial(make_cards, base, cache, engine, image_options)
+    for cards in map_parallel(f, list(markdowns.items()), jobs, "make cards"):
+        for card in cards:
+            match meta.get(card.path, Meta(None, None)).get_by_direction(
+                card.direction
+            ):
                 case None:
                     new_cards.append(card)
                 case str(card_id):
@@ -173,39 +368,141 @@ def get_cards(
     return existing_cards, new_cards
 
 
+def map_parallel[R](
+    f: Callable[..., R], items: list[tuple[Any, ...]], jobs: int, desc: str
+) -> Iterator[R]:
+    """
+    f(*item) for all items, on jobs processes, in the order of items
+    the first element of every item is the path that is noted on errors
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    from tqdm import tqdm
+
+    if jobs == 1:
+        with profiling.span(desc):
+            yield from map(partial(noted, f), tqdm(items, desc=desc))
+        return
+    with (
+        profiling.span(desc, jobs=jobs),
+        ProcessPoolExecutor(
+            jobs, initializer=workers.start_in_child, initargs=(workers.size(),)
+        ) as executor,
+    ):
+        chunksize = max(1, min(64, len(items) // (4 * jobs)))
+        if not profiling.is_enabled():
+            results = executor.map(partial(noted, f), items, chunksize=chunksize)
+            yield from tqdm(results, total=len(items), desc=desc)
+            return
+        # NOTE what the workers record comes back with each result
+        results = executor.map(
+            partial(profiling.collected, partial(noted, f)), items, chunksize=chunksize
+        )
+        for result, records in tqdm(results, total=len(items), desc=desc):
+            profiling.merge(records)
+            yield result
+
+
+def noted[R](f: Callable[..., R], item: tuple[Any, ...]) -> R:
+    try:
+        return f(*item)
+    except Exception as e:
+        e.add_note(f"while processing {item[0]}")
+        raise
+
+
 @dataclass
 class Images:
     base: Path
-    next_index: int
     data: dict[str, bytes]
-    max_width: int = 800
+    options: ImageOptions = field(default_factory=ImageOptions)
+    cache: None | Cache = None
 
     @classmethod
-    def from_base(cls, base: Path):
-        return cls(base, 0, {})
+    def from_base(
+        cls, base: Path, cache: None | Cache = None, options: None | ImageOptions = None
+    ):
+        return cls(base, {}, options or ImageOptions(), cache)
 
     def collect(self, path: str) -> tuple[str, str]:
-        local = self.base / path
+        data, hash, extension = encode_image(self.cache, self.base / path, self.options)
+        # NOTE the name is derived from the content, so it is stable when other images change
+        # and an attachment with the same name on the remote does not need to be uploaded again
         # TODO mochis requirements on names here a bit arbitrary, and not correctly documented too
-        name = f"i{self.next_index:08}.png"
-        remote = f"@media/{name}"
-        self.next_index += 1
+        name = f"{hash[:16]}.{extension}"
+        self.data[name] = data
+        return f"@media/{name}", hash
 
-        with Image.open(local) as image:
-            if image.width > self.max_width:
-                height = round(image.height * self.max_width / image.width)
-                image = image.resize((self.max_width, height))
-            data = BytesIO()
-            image.save(data, "png")
-            self.data[name] = data.getvalue()
+    def as_api_attachments(self) -> list[Attachment]:
+        from cman.api import Attachment
 
-        hash = sha256()
-        hash.update(self.data[name])
+        return [Attachment(name, data) for name, data in self.data.items()]
 
-        return remote, hash.hexdigest()
 
-    def as_api_attachments(self) -> list[Attachment]:
-        return [Attachment(name, data) for name, data in self.data.items()]
+# NOTE per process, so that images used by many cards are only encoded once per run
+encoded_images: dict[str, tuple[bytes, str, str]] = {}
+
+
+def encode_image(
+    cache: None | Cache, path: Path, options: ImageOptions
+) -> tuple[bytes, str, str]:
+    """encoded data, its sha256, and its extension, cached by the content of the source image"""
+    # NOTE an unchanged file only costs a stat, the content hash is cached by stat
+    stat = path.stat()
+    stat_key = key_of(
+        "image-source",
+        str(path.absolute()),
+        str(stat.st_size),
+        str(stat.st_mtime_ns),
+    )
+    source = None if cache is None else cache.get(stat_key)
+    if not isinstance(source, str):
+        source = sha256(path.read_bytes()).hexdigest()
+        if cache is not None:
+            cache.put(stat_key, source)
+
+    key = key_of("image", source, *options.key())
+    if key in encoded_images:
+        return encoded_images[key]
+
+    match None if cache is None else cache.get(key):
+        case (bytes(), str(), str()) as encoded:
+            pass
+        case _:
+            start = time.perf_counter()
+            from cman.images import encode
+
+            with profiling.span("encode image"):
+                data, extension = encode(path, options)
+            encoded = data, sha256(data).hexdigest(), extension
+            profiling.count("encode image", time.perf_counter() - start, len(data))
+            if cache is not None:
+                cache.put(key, encoded)
+
+    encoded_images[key] = encoded
+    return encoded
+
+
+def encode_images(
+    cache: None | Cache, paths: Set[tuple[Path, ImageOptions]], threads: int
+):
+    """
+    encode_image for all paths up front, on threads, pillow releases the gil while it works
+    the results are in encoded_images, and in the cache for worker processes
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def f(item: tuple[Path, ImageOptions]):
+        # NOTE errors show again with their card, see make_cards
+        with suppress(Exception):
+            encode_image(cache, *item)
+
+    with (
+        profiling.span("encode images", threads=threads),
+        ThreadPoolExecutor(max(1, threads)) as executor,
+    ):
+        for _ in executor.map(f, paths):
+            pass
 
 
 def move(base: Path, source: Path, target: Path):
@@ -246,7 +543,10 @@ def move(base: Path, source: Path, target: Path):
 
     meta[based_target] = meta.pop(based_source)
 
-    image_paths = Markdown.from_path(base / based_source).get_image_paths()
+    # NOTE the python engine reads most cards without starting pandoc, see cman.minimd
+    image_paths = Markdown.from_path(
+        base / based_source, Engine.python
+    ).get_image_paths()
     if based_source.parent != based_target.parent:
         for ip in image_paths:
             if (base / based_target.parent / ip).exists():
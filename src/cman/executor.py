@@ -0,0 +1,140 @@
+"""
+run many independent api operations concurrently
+the number of operations in flight adapts to the server
+it grows slowly while things work, and halves on rate limits and server errors
+"""
+
+from __future__ import annotations
+
+import random
+import signal
+import sys
+import threading
+import time
+from collections import Counter, deque
+from collections.abc import Callable, Iterator, Sequence
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from threading import Event
+
+from cman.api import ApiError
+
+
+@dataclass
+class Report:
+    started: float = field(default_factory=time.monotonic)
+    done: Counter[str] = field(default_factory=Counter)
+    retried: Counter[str] = field(default_factory=Counter)
+    failed: Counter[str] = field(default_factory=Counter)
+    failures: list[tuple[str, Exception]] = field(default_factory=list)
+
+    def print_summary(self):
+        seconds = time.monotonic() - self.started
+        for kind in sorted(self.done | self.retried | self.failed):
+            print(
+                f"{kind}: {self.done[kind]} done, "
+                f"{self.retried[kind]} retried, "
+                f"{self.failed[kind]} failed"
+            )
+        total = self.done.total()
+        print(f"{total} operations in {seconds:.1f}s, {total / seconds:.1f}/s")
+        for description, error in self.failures:
+            print(f"failed {description}: {error}", file=sys.stderr)
+
+
+def run_adaptive[T, R](
+    operations: Sequence[T],
+    run: Callable[[T], R],
+    describe: Callable[[T], tuple[str, str]],  # kind and description
+    report: Report,
+    max_in_flight: int = 8,
+    max_attempts: int = 5,
+    stop: None | Event = None,
+) -> Iterator[tuple[T, R]]:
+    """
+    yields operations and their results in the order they complete
+    failed operations are not yielded, but recorded in the report
+    when stop is set, no more operations are started, and it ends when the ones in flight are done
+    """
+    stop = stop or Event()
+    pending = deque(operations)
+    attempts: Counter[int] = Counter()
+    in_flight: dict[Future[R], T] = {}
+    limit = 1.0
+    not_before = 0.0
+
+    with ThreadPoolExecutor(max_in_flight) as executor:
+        while (len(pending) > 0 and not stop.is_set()) or len(in_flight) > 0:
+            while (
+                len(pending) > 0
+                and len(in_flight) < int(limit)
+                and time.monotonic() >= not_before
+                and not stop.is_set()
+            ):
+                operation = pending.popleft()
+                in_flight[executor.submit(run, operation)] = operation
+
+            if len(in_flight) == 0:
+                stop.wait(max(0.0, not_before - time.monotonic()))
+                continue
+
+            timeout = None
+            if len(pending) > 0 and len(in_flight) < int(limit) and not stop.is_set():
+                timeout = max(0.0, not_before - time.monotonic())
+            done, _ = wait(in_flight, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                operation = in_flight.pop(future)
+                kind, description = describe(operation)
+                try:
+                    result = future.result()
+                except ApiError as e:
+                    attempts[id(operation)] += 1
+                    if e.is_transient() and attempts[id(operation)] < max_attempts:
+                        # NOTE multiplicative decrease, and wait as told, or back off with jitter
+                        limit = max(1.0, limit / 2)
+                        delay = e.retry_after
+                        if delay is None:
+                            delay = random.uniform(0, 2 ** attempts[id(operation)])
+                        not_before = max(not_before, time.monotonic() + delay)
+                        report.retried[kind] += 1
+                        pending.appendleft(operation)
+                    else:
+                        report.failed[kind] += 1
+                        report.failures.append((description, e))
+                except Exception as e:
+                    report.failed[kind] += 1
+                    report.failures.append((description, e))
+                else:
+                    # NOTE additive increase, about one more per limit successes
+                    limit = min(float(max_in_flight), limit + 1 / limit)
+                    report.done[kind] += 1
+                    yield operation, result
+
+
+@contextmanager
+def graceful_interrupt() -> Iterator[Event]:
+    """
+    the first ctrl-c sets the event, to finish what is in flight and then stop, see run_adaptive
+    a second ctrl-c interrupts as usual
+    """
+    stop = Event()
+    # NOTE signal handlers can only be set from the main thread
+    if threading.current_thread() is not threading.main_thread():
+        yield stop
+        return
+
+    def handler(signum, frame):
+        print(
+            "\nStopping when the operations in flight are done, ctrl-c again to not wait.",
+            file=sys.stderr,
+        )
+        stop.set()
+        signal.signal(signal.SIGINT, previous)
+
+    previous = signal.signal(signal.SIGINT, handler)
+    try:
+        yield stop
+    finally:
+        signal.signal(signal.SIGINT, previous)
@@ -0,0 +1,166 @@
+"""
+how images are encoded for upload, configurable per deck, see Config.images
+the default is what cman always did, a full colour png at most 800 wide, so that existing attachments do not change
+smaller are palette pngs for screenshots, jpeg or webp for photos, and a byte budget per image
+"""
+
+from __future__ import annotations
+
+from dataclasses import astuple, dataclass, replace
+from io import BytesIO
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+if TYPE_CHECKING:
+    from PIL.Image import Image
+
+type Format = Literal["png", "jpeg", "webp", "auto"]
+
+extensions = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+# NOTE what a byte budget tries, in this order, before it makes the image smaller
+budget_colors = [256, 64, 16]
+budget_qualities = [70, 55, 40]
+budget_scales = [0.75, 0.5, 0.35, 0.25]
+
+
+@dataclass(frozen=True)
+class ImageOptions:
+    # png, jpeg, webp, or auto, which is png for few colours, like screenshots, and jpeg otherwise, like photos
+    # NOTE mochi shows jpeg everywhere, but webp only where the browser or app supports it
+    format: Format = "png"
+    max_width: int = 800
+    # pngs get a palette of at most that many colours, 0 keeps all colours
+    colors: int = 0
+    # of jpeg and webp, 1 to 95
+    quality: int = 85
+    # smaller pngs and jpegs, but slower to encode
+    optimize: bool = False
+    # downscale with draft for jpegs, and reduce by integer factors first, faster, but a bit softer
+    fast_downscale: bool = False
+    # bytes, larger images are encoded again with fewer colours, or less quality, then smaller, 0 is no budget
+    max_bytes: int = 0
+
+    def key(self) -> list[str]:
+        """for cache keys"""
+        return [str(v) for v in astuple(self)]
+
+
+def encode(path: Path, options: ImageOptions) -> tuple[bytes, str]:
+    """the encoded image, and its file extension"""
+    from PIL import Image
+
+    with Image.open(path) as image:
+        size = (
+            options.max_width,
+            round(image.height * options.max_width / image.width),
+        )
+        if options.fast_downscale and image.width > options.max_width:
+            # NOTE only jpegs draft, they decode at 1/2, 1/4, or 1/8 of the size directly
+            image.draft(None, size)
+        # NOTE before downscaling, that blends the flat colours of screenshots at their edges
+        format, options = choose_format(image, options)
+        if image.width > options.max_width:
+            if options.fast_downscale:
+                image = image.resize(size, reducing_gap=3.0)
+            else:
+                image = image.resize(size)
+
+        data = save(image, format, options)
+        if options.max_bytes == 0 or len(data) <= options.max_bytes:
+            return data, extensions[format]
+
+        best = data
+        for attempt in budget_attempts(format, options, image.width):
+            scaled = image
+            if attempt.max_width < image.width:
+                height = round(image.height * attempt.max_width / image.width)
+                scaled = image.resize((attempt.max_width, height), reducing_gap=3.0)
+            data = save(scaled, format, attempt)
+            if len(data) < len(best):
+                best = data
+            if len(data) <= options.max_bytes:
+                break
+        # NOTE if nothing fits, the smallest we got
+        return best, extensions[format]
+
+
+def choose_format(
+    image: Image, options: ImageOptions
+) -> tuple[Literal["png", "jpeg", "webp"], ImageOptions]:
+    """the format for auto, and for few colours a palette, the options are as given otherwise"""
+    match options.format:
+        case "auto":
+            if is_screenshot(image):
+                return "png", replace(options, colors=options.colors or 256)
+            if has_alpha(image):
+                return "png", options
+            return "jpeg", options
+        case format:
+            return format, options
+
+
+def budget_attempts(format: str, options: ImageOptions, width: int):
+    """options that make the image smaller, first without, then with fewer pixels"""
+    attempt = options
+    if format == "png":
+        for colors in budget_colors:
+            if attempt.colors == 0 or colors < attempt.colors:
+                attempt = replace(attempt, colors=colors)
+                yield attempt
+    else:
+        for quality in budget_qualities:
+            if quality < attempt.quality:
+                attempt = replace(attempt, quality=quality)
+                yield attempt
+    for scale in budget_scales:
+        yield replace(attempt, max_width=max(16, round(width * scale)))
+
+
+def is_screenshot(image: Image) -> bool:
+    """
+    screenshots and diagrams are mostly a few flat colours, a palette png keeps them sharp
+    anti-aliased text adds many colours, but only few pixels have them
+    """
+    counts = image.getcolors(4096)
+    if counts is None:
+        return False
+    top = sorted((n for n, _ in counts), reverse=True)[:256]
+    return sum(top) >= 0.99 * image.width * image.height
+
+
+def has_alpha(image: Image) -> bool:
+    return image.mode in ["RGBA", "LA", "PA"] or "transparency" in image.info
+
+
+def save(image: Image, format: str, options: ImageOptions) -> bytes:
+    from PIL import Image
+
+    data = BytesIO()
+    match format:
+        case "png":
+            if options.colors > 0:
+                if image.mode not in ["RGB", "RGBA"]:
+                    image = image.convert("RGBA" if has_alpha(image) else "RGB")
+                # NOTE median cut does not do alpha
+                method = (
+                    Image.Quantize.FASTOCTREE
+                    if image.mode == "RGBA"
+                    else Image.Quantize.MEDIANCUT
+                )
+                image = image.quantize(options.colors, method=method)
+            image.save(data, "png", optimize=options.optimize)
+        case "jpeg":
+            image.convert("RGB").save(
+                data, "jpeg", quality=options.quality, optimize=options.optimize
+            )
+        case "webp":
+            image.save(
+                data,
+                "webp",
+                quality=options.quality,
+                method=6 if options.optimize else 4,
+            )
+        case _:
+            assert False, format
+    return data.getvalue()
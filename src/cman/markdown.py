@@ -4,29 +4,99 @@ but the type annotations dont work with pyright
 because they are non-standard and generated
 so we put all "unsafe" code here behind a
 type-safe interface for the rest of the code base
+the pandoc package is slow to import and to configure, so it is only loaded when needed, see pandoc_types
 """
 
 from __future__ import annotations
 
+import os
+import shutil
+import time
 from collections.abc import Callable, Iterator
 from copy import deepcopy
 from dataclasses import dataclass
 from enum import Enum
+from functools import cache
 from pathlib import Path
+from types import ModuleType
+from typing import TYPE_CHECKING
 
-import pandoc
-from pandoc.types import (
-    Block,  # pyright: ignore
-    Emph,  # pyright: ignore
-    HorizontalRule,  # pyright: ignore
-    Image,  # pyright: ignore
-    Inline,  # pyright: ignore
-    Meta,  # pyright: ignore
-    Pandoc,  # pyright: ignore
-    Para,  # pyright: ignore
-    Space,  # pyright: ignore
-    Str,  # pyright: ignore
-)
+from cman import profiling, workers
+
+if TYPE_CHECKING:
+    from pandoc.types import (
+        Block,  # pyright: ignore
+        Inline,  # pyright: ignore
+        Pandoc,  # pyright: ignore
+    )
+
+
+# NOTE columns=3 and wrap=none forces rulers to be exactly 3 dashes (---)
+# mochi accepts only exactly 3 dashes (---) as a new page
+mochi_format = "markdown+hard_line_breaks"
+mochi_options = ["--columns=3", "--wrap=none"]
+
+
+@cache
+def pandoc_types() -> ModuleType:
+    """
+    pandoc.types, with pandoc configured
+    configuring probes the pandoc binary for its version, we cache that by the binary's stat
+    """
+    import pandoc
+
+    from cman.cache import Cache, key_of
+
+    path = shutil.which("pandoc")
+    if pandoc.configure(read=True) is not None or path is None:
+        import pandoc.types
+
+        return pandoc.types
+
+    # NOTE an update of the binary or the package changes their stat
+    stats = [os.stat(path), os.stat(pandoc.__file__)]
+    key = key_of(
+        "pandoc-version",
+        path,
+        *(f"{s.st_size}:{s.st_mtime_ns}" for s in stats),
+    )
+    cache = Cache.default()
+    match cache.get(key):
+        case {"version": str(), "pandoc_types_version": str()} as probed:
+            # NOTE importing pandoc.types configures from what is set, without path it does not probe
+            pandoc._configuration = {"auto": False, "path": None, **probed}  # pyright: ignore
+            import pandoc.types
+
+            pandoc._configuration["path"] = path  # pyright: ignore
+        case _:
+            import pandoc.types
+
+            configuration = pandoc.configure(read=True)
+            assert configuration is not None
+            cache.put(
+                key,
+                {
+                    "version": configuration["version"],
+                    "pandoc_types_version": configuration["pandoc_types_version"],
+                },
+            )
+    return pandoc.types
+
+
+def pandoc_version() -> str:
+    import pandoc
+
+    pandoc_types()
+    configuration = pandoc.configure(read=True)
+    assert configuration is not None
+    return configuration["version"]
+
+
+class Engine(Enum):
+    # NOTE pandoc for everything
+    pandoc = "pandoc"
+    # NOTE cman.minimd where it can, pandoc for the rest
+    python = "python"
 
 
 class Direction(Enum):
@@ -39,39 +109,50 @@ class Markdown:
     body: list[Block]
 
     @classmethod
-    def from_str(cls, text: str):
-        _, body = pandoc.read(text, format="markdown")  # pyright: ignore
+    def from_str(cls, text: str, engine: Engine = Engine.pandoc):
+        if engine == Engine.python:
+            pandoc_types()
+            from cman import minimd
+
+            body = minimd.read(text)
+            if body is not None:
+                return cls(body)
+        _, body = read_with_pandoc(text, "markdown")  # pyright: ignore
         assert type(body) is list, type(body)
         return cls(body)
 
     @classmethod
-    def from_path(cls, path: Path):
-        return cls.from_str(path.read_text())
-
-    def as_mochi_md_str(self) -> str:
-        data = pandoc.write(
-            Pandoc(Meta({}), self.body),
-            format="markdown+hard_line_breaks",
-            # NOTE columns=3 and wrap=none forces rulers to be exactly 3 dashes (---)
-            # mochi accepts only exactly 3 dashes (---) as a new page
-            options=["--columns=3", "--wrap=none"],
-        )
+    def from_path(cls, path: Path, engine: Engine = Engine.pandoc):
+        return cls.from_str(path.read_text(), engine)
+
+    def as_mochi_md_str(self, engine: Engine = Engine.pandoc) -> str:
+        if engine == Engine.python:
+            pandoc_types()
+            from cman import minimd
+
+            data = minimd.write(self.body)
+            if data is not None:
+                return data
+        data = write_with_pandoc(self.body, mochi_format, mochi_options)
         # TODO note sure in what case we get what
         assert type(data) is str, type(data)
         return data
 
+    def as_html(self, options: list[str]) -> str:
+        html = write_with_pandoc(self.body, "html", options)
+        assert type(html) is str, type(html)
+        return html
+
     def as_formatted(self) -> str:
-        formatted = pandoc.write(
-            Pandoc(Meta({}), self.body),  # pyright: ignore[reportAttributeAccessIssue]
-            # NOTE this is the format i use in nvim too
-            format="markdown",
-        )
+        # NOTE this is the format i use in nvim too
+        formatted = write_with_pandoc(self.body, "markdown", [])
         assert type(formatted) is str, type(formatted)
         return formatted
 
     def reversed(self) -> Markdown:
+        t = pandoc_types()
         first, second = split_blocks(self.body)
-        return Markdown(second + [HorizontalRule()] + first)
+        return Markdown(second + [t.HorizontalRule()] + first)
 
     def oriented(self, direction: Direction) -> Markdown:
         match direction:
@@ -94,13 +175,14 @@ class Markdown:
                 assert False, prompts
 
     def maybe_prompted(self) -> Markdown:
+        t = pandoc_types()
         question, answer = split_blocks(self.body)
 
         def f(block: Block):
             prompt = maybe_match_prompt(block)
             if prompt is None:
                 return block
-            return Para([Emph(prompt)])
+            return t.Para([t.Emph(prompt)])
 
         question = [f(b) for b in question]
 
@@ -111,38 +193,82 @@ class Markdown:
             return None
 
         answer = [b for b in map(g, answer) if b is not None]
-        return Markdown(question + [HorizontalRule()] + answer)
+        return Markdown(question + [t.HorizontalRule()] + answer)
 
     def with_rewritten_images(
         self, transform: Callable[[str], tuple[str, str]]
     ) -> Markdown:
+        import pandoc
+
+        t = pandoc_types()
         body = deepcopy(self.body)
         for block in pandoc.iter(body):
             match block:
-                case Image(_, _, (path, _)):
+                case t.Image(_, _, (path, _)):
                     # TODO what happens to the iter if we change things as we go?
                     block[2] = transform(path)
         return Markdown(body)
 
     def get_image_paths(self) -> list[Path]:
+        import pandoc
+
+        t = pandoc_types()
+
         def g() -> Iterator[Path]:
             for block in pandoc.iter(self.body):
                 match block:
-                    case Image(_, _, (path, _)):
+                    case t.Image(_, _, (path, _)):
                         yield Path(path)
 
         return list(g())
 
 
+def read_with_pandoc(text: str, format: str) -> Pandoc:
+    import pandoc
+
+    pandoc_types()
+    with profiling.span("pandoc read", format=format):
+        start = time.perf_counter()
+        if workers.pool is None:
+            doc = pandoc.read(text, format=format)
+            profiling.count("pandoc process", time.perf_counter() - start)
+            return doc
+        data = workers.pool.convert(text, format, "json", [])
+        profiling.count("pandoc worker", time.perf_counter() - start)
+        # NOTE reading json is done in python by the pandoc package, without a process
+        return pandoc.read(data, format="json")
+
+
+def write_with_pandoc(body: list[Block], format: str, options: list[str]) -> str:
+    import pandoc
+
+    t = pandoc_types()
+    doc = t.Pandoc(t.Meta({}), body)
+    with profiling.span("pandoc write", format=format):
+        if workers.pool is None:
+            start = time.perf_counter()
+            text = pandoc.write(doc, format=format, options=options)
+            profiling.count("pandoc process", time.perf_counter() - start)
+            return text
+        # NOTE writing json is done in python by the pandoc package, without a process
+        data = pandoc.write(doc, format="json")
+        start = time.perf_counter()
+        text = workers.pool.convert(data, "json", format, options)
+        profiling.count("pandoc worker", time.perf_counter() - start)
+        return text
+
+
 def split_blocks(blocks: list[Block]) -> tuple[list[Block], list[Block]]:
-    [split] = [i for i, e in enumerate(blocks) if e == HorizontalRule()]
+    t = pandoc_types()
+    [split] = [i for i, e in enumerate(blocks) if e == t.HorizontalRule()]
     return blocks[:split], blocks[split + 1 :]
 
 
 def maybe_match_prompt(block: Block) -> None | list[Inline]:
+    t = pandoc_types()
     match block:
         # TODO is ! even okay? or does it clash with ![]() for images?
-        case Para([Str("!" | "prompt:" | "Prompt:"), Space(), *prompt]):
+        case t.Para([t.Str("!" | "prompt:" | "Prompt:"), t.Space(), *prompt]):
             return prompt
         case _:
             return None
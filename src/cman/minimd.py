@@ -0,0 +1,243 @@
+"""
+an in-process reader and writer for the small subset of markdown most cards use
+plain paragraphs with text, emphasis, code, math and images, and horizontal rules
+anything outside of that subset returns None, and the caller falls back to pandoc
+the produced ast is the same as what pandoc would produce
+and the written text is the same as pandoc's mochi_format with mochi_options
+"""
+
+from __future__ import annotations
+
+import re
+
+from pandoc.types import (
+    Block,  # pyright: ignore
+    Code,  # pyright: ignore
+    DisplayMath,  # pyright: ignore
+    Emph,  # pyright: ignore
+    HorizontalRule,  # pyright: ignore
+    Image,  # pyright: ignore
+    Inline,  # pyright: ignore
+    InlineMath,  # pyright: ignore
+    Math,  # pyright: ignore
+    Para,  # pyright: ignore
+    SoftBreak,  # pyright: ignore
+    Space,  # pyright: ignore
+    Str,  # pyright: ignore
+    Strong,  # pyright: ignore
+)
+
+# NOTE from 'pandoc --print-default-data-file=abbreviations'
+# with the smart extension, pandoc joins these with the next word using a nbsp
+abbreviations = frozenset(
+    "aet. aetat. al. Apr. Aug. bk. Bros. c. Capt. cf. ch. chap. chs. Co. col. "
+    "Corp. cp. d. Dec. Dr. e.g. ed. eds. esp. f. fasc. Feb. ff. fig. fl. fol. "
+    "fols. Fr. Gen. Gov. Hon. i.e. ill. Inc. incl. Jan. Jr. Jul. Jun. Ltd. M.A. "
+    "M.D. Mar. Mr. Mrs. Ms. n. n.b. nn. No. Nov. Oct. p. Ph.D. pp. Pres. Prof. "
+    "pt. q.v. Rep. Rev. s.v. s.vv. saec. sec. Sen. Sep. Sept. Sgt. Sr. St. "
+    "univ. viz. vol. vs.".split()
+)
+
+no_attr = ("", [], [])
+
+text = r"(?:[^\W_]|[,.;:?()/%-]|!(?!\[))+"
+text_re = re.compile(text)
+inline_re = re.compile(
+    rf"""
+    (?P<space>\ +)
+    | (?P<text>{text})
+    | !\[(?P<alt>[^\[\]]*)\]\((?P<src>[\w./@-]+)\)
+    | \$\$(?P<display>[^\s$\\]|[^\s$][^$]*[^\s$\\])\$\$
+    | \$(?P<math>[^\s$\\]|[^\s$][^$]*[^\s$\\])\$(?!\d)
+    | `(?P<code>[^\s`]|[^\s`][^`]*[^\s`])`
+    | \*\*(?P<strong>[^\s*][^*]*[^\s*]|[^\s*])\*\*
+    | \*(?P<emph>[^\s*][^*]*[^\s*]|[^\s*])\*
+    """,
+    re.VERBOSE,
+)
+# NOTE list markers, like '1.', 'a)', or 'iv.'
+list_marker_re = re.compile(r"(\d+|[A-Za-z]|[ivxlcdmIVXLCDM]+)[.)]")
+rule_re = re.compile(r"-{3,}")
+
+
+def read(text: str) -> None | list[Block]:
+    blocks: list[Block] = []
+    lines: list[str] = []
+    for line in [*text.split("\n"), ""]:
+        if line != "":
+            lines.append(line)
+            continue
+        if len(lines) == 0:
+            continue
+        match lines:
+            case [rule] if rule_re.fullmatch(rule):
+                blocks.append(HorizontalRule())
+            case _:
+                para = read_para(lines)
+                if para is None:
+                    return None
+                blocks.append(para)
+        lines = []
+    return blocks
+
+
+def read_para(lines: list[str]) -> None | Block:
+    inlines: list[Inline] = []
+    for line in lines:
+        if line != line.strip(" ") or "  " in line:
+            # NOTE indentation is code, and two trailing spaces are a line break
+            return None
+        line_inlines = read_inlines(line)
+        if line_inlines is None or not is_safe_start(line_inlines):
+            return None
+        if len(inlines) > 0:
+            inlines.append(SoftBreak())
+        inlines.extend(line_inlines)
+    match inlines:
+        case [Image(_, [_, *_], _)]:
+            # NOTE a lonely image with a caption is a Figure, leave that to pandoc
+            return None
+    return Para(inlines)
+
+
+def read_inlines(line: str, nested: bool = False) -> None | list[Inline]:
+    inlines: list[Inline] = []
+    at = 0
+    while at < len(line):
+        m = inline_re.match(line, at)
+        if m is None:
+            return None
+        at = m.end()
+        match m.lastgroup:
+            case "space":
+                inlines.append(Space())
+            case "text":
+                inlines.append(Str(m["text"]))
+            case "src" if not nested:
+                alt = read_inlines(m["alt"], nested=True)
+                if alt is None:
+                    return None
+                inlines.append(Image(no_attr, alt, (m["src"], "")))
+            case "display" if not nested:
+                inlines.append(Math(DisplayMath(), m["display"]))
+            case "math" if not nested:
+                inlines.append(Math(InlineMath(), m["math"]))
+            case "code" if not nested:
+                inlines.append(Code(no_attr, m["code"]))
+            case "strong" if not nested:
+                strong = read_inlines(m["strong"], nested=True)
+                if strong is None:
+                    return None
+                inlines.append(Strong(strong))
+            case "emph" if not nested:
+                emph = read_inlines(m["emph"], nested=True)
+                if emph is None:
+                    return None
+                inlines.append(Emph(emph))
+            case _:
+                return None
+    if not all(map(is_safe, inlines, inlines[1:] + [None])):
+        return None
+    return inlines
+
+
+def write(blocks: list[Block]) -> None | str:
+    parts: list[str] = []
+    for block in blocks:
+        match block:
+            case HorizontalRule():
+                parts.append("---")
+            case Para(inlines) if is_safe_start(inlines):
+                part = write_inlines(inlines)
+                if part is None:
+                    return None
+                parts.append(part)
+            case _:
+                return None
+    if len(parts) == 0:
+        return None
+    return "\n\n".join(parts) + "\n"
+
+
+def write_inlines(inlines: list[Inline]) -> None | str:
+    if not all(map(is_safe, inlines, inlines[1:] + [None])):
+        return None
+    parts: list[str] = []
+    for inline in inlines:
+        match inline:
+            case Str(s):
+                parts.append(s)
+            case Space() | SoftBreak():
+                # NOTE with --wrap=none pandoc writes soft breaks as spaces
+                parts.append(" ")
+            case Math(InlineMath(), s):
+                parts.append(f"${s}$")
+            case Math(DisplayMath(), s):
+                parts.append(f"$${s}$$")
+            case Code(attr, s) if attr == no_attr:
+                parts.append(f"`{s}`")
+            case Image(attr, alt, (src, title)) if attr == no_attr:
+                alt = write_inlines(alt)
+                if alt is None or not re.fullmatch(r"[\w./@-]+", src):
+                    return None
+                if title == "":
+                    parts.append(f"![{alt}]({src})")
+                elif re.fullmatch(r"\w+", title):
+                    parts.append(f'![{alt}]({src} "{title}")')
+                else:
+                    return None
+            case Emph(emph) if is_safe_nested(emph):
+                emph = write_inlines(emph)
+                if emph is None:
+                    return None
+                parts.append(f"*{emph}*")
+            case Strong(strong) if is_safe_nested(strong):
+                strong = write_inlines(strong)
+                if strong is None:
+                    return None
+                parts.append(f"**{strong}**")
+            case _:
+                return None
+    return "".join(parts)
+
+
+def is_safe(inline: Inline, next: None | Inline) -> bool:
+    """things that are fine for pandoc, but they would read or write differently"""
+    match inline, next:
+        case Str(s), _ if not text_re.fullmatch(s):
+            return False
+        case Str(s), _ if ".." in s or "--" in s:
+            # NOTE smart extension makes ellipses and dashes
+            return False
+        case Str(s), (Space() | SoftBreak()) if s in abbreviations:
+            return False
+        case Str(s), Image() if s.endswith("!"):
+            return False
+        case Str(), Str():
+            # NOTE pandoc would have merged them
+            return False
+        case Math(_, s), _ if "\n" in s:
+            return False
+        case Code(_, s), _ if "\n" in s or "  " in s:
+            return False
+    return True
+
+
+def is_safe_start(inlines: list[Inline]) -> bool:
+    """can this start a line without being read as something else than text?"""
+    match inlines:
+        case [Str("!"), Space(), *_] | [Str("!")]:
+            return True
+        case [Str(s), *_]:
+            return s[0].isalnum() and not list_marker_re.fullmatch(s)
+        case [Image() | Math() | Code() | Emph() | Strong(), *_]:
+            return True
+        case _:
+            return False
+
+
+def is_safe_nested(inlines: list[Inline]) -> bool:
+    match inlines:
+        case [Space() | SoftBreak(), *_] | [*_, Space() | SoftBreak()] | []:
+            return False
+    return all(isinstance(i, (Str, Space, SoftBreak)) for i in inlines)
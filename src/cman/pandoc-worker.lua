@@ -0,0 +1,58 @@
+-- a long-lived pandoc, run with 'pandoc lua', see cman.workers
+-- reads one json request per line from stdin
+-- writes one json response per line to stdout
+-- supports only the few command line options that cman uses
+
+local templates = {}
+
+local function compile_template(path)
+  if templates[path] == nil then
+    local file = assert(io.open(path, "r"))
+    templates[path] = pandoc.template.compile(file:read("a"), path)
+    file:close()
+  end
+  return templates[path]
+end
+
+local function convert(request)
+  if request.ping then
+    return "pong"
+  end
+  local doc = pandoc.read(request.text, request.from)
+  local options = { variables = {} }
+  for _, option in ipairs(request.options) do
+    local key, value = option:match("^%-%-([%w-]+)=(.*)$")
+    if key == "columns" then
+      options.columns = tonumber(value)
+    elseif key == "wrap" then
+      options.wrap_text = "wrap-" .. value
+    elseif key == "template" then
+      options.template = compile_template(value)
+    elseif key == "variable" then
+      local k, v = value:match("^([^:=]*)[:=](.*)$")
+      options.variables[k] = v
+    elseif key == "metadata" then
+      local k, v = value:match("^([^:=]*)[:=](.*)$")
+      doc.meta[k] = v
+    elseif key == "katex" then
+      options.html_math_method = { method = "katex", url = value }
+    else
+      error("unsupported option " .. option)
+    end
+  end
+  return pandoc.write(doc, request.to, options)
+end
+
+for line in io.stdin:lines() do
+  local ok, result = pcall(function()
+    return convert(pandoc.json.decode(line, false))
+  end)
+  local response
+  if ok then
+    response = { output = result }
+  else
+    response = { error = tostring(result) }
+  end
+  io.stdout:write(pandoc.json.encode(response), "\n")
+  io.stdout:flush()
+end
@@ -0,0 +1,193 @@
+"""
+the operations of a sync, written before they are applied, see 'cman plan' and 'cman apply'
+every operation is marked in a journal when it is done
+so that a sync that was interrupted, or failed halfway, continues with what is left, see 'cman sync --resume'
+the plan is in .sync-plan in the base of the cards, attachments are stored once, by name
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import shutil
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Literal
+
+from cman.api import Attachment
+from cman.data import (
+    Card,
+    Meta,
+    Remote,
+    append_journal,
+    read_journaled,
+    write_compacted,
+)
+from cman.markdown import Direction
+
+if TYPE_CHECKING:
+    from cman.state import MochiDiff
+
+
+type Operation = (
+    tuple[Literal["update"], str, Card, list[Attachment]]
+    | tuple[Literal["delete"], str]
+    | tuple[Literal["create"], Card]
+)
+
+
+@dataclass
+class Plan:
+    decks: dict[str, str]  # deck name -> mochi deck id, as when planned
+    operations: list[Operation]
+    done: set[int]  # indices of operations
+    created: float  # seconds since the epoch
+
+    @classmethod
+    def from_diff(
+        cls, diff: MochiDiff, decks: dict[str, str], remote: dict[str, Remote]
+    ):
+        """remote is the snapshot, to not upload attachments again"""
+        operations: list[Operation] = []
+        for id, card in diff.changed.items():
+            uploaded = set(remote.get(id, Remote([])).attachments)
+            # NOTE attachment names are content hashes, same name means same data
+            missing = [a for a in card.attachments if a.file_name not in uploaded]
+            operations.append(("update", id, card, missing))
+        operations.extend(("delete", id) for id in diff.removed)
+        operations.extend(("create", card) for card in diff.new)
+        return cls(dict(decks), operations, set(), time.time())
+
+    def remaining(self, meta: dict[Path, Meta]) -> dict[int, Operation]:
+        """
+        operations that are not done yet
+        a create is done if meta has an id for it already,
+        it was created, but not marked before the sync stopped
+        """
+
+        def is_created(card: Card) -> bool:
+            m = meta.get(card.path, Meta(None, None))
+            return m.get_by_direction(card.direction) is not None
+
+        return {
+            i: operation
+            for i, operation in enumerate(self.operations)
+            if i not in self.done
+            and not (operation[0] == "create" and is_created(operation[1]))
+        }
+
+    def print_summary(self, remaining: dict[int, Operation]):
+        kinds = Counter(operation[0] for operation in remaining.values())
+        at = datetime.datetime.fromtimestamp(self.created).isoformat(timespec="seconds")
+        print(
+            f"{len(remaining)} of {len(self.operations)} operations left "
+            f"from the plan at {at}: "
+            f"{kinds['delete']} removed, "
+            f"{kinds['update']} changed, "
+            f"{kinds['create']} new cards"
+        )
+
+
+def path_of(base: Path) -> Path:
+    return base / ".sync-plan"
+
+
+def exists(base: Path) -> bool:
+    return (path_of(base) / "plan.json").exists()
+
+
+def card_as_json(card: Card) -> dict:
+    return {
+        "content": card.content,
+        "deck_name": card.deck_name,
+        "attachments": [a.file_name for a in card.attachments],
+        "path": str(card.path),
+        "direction": card.direction.value,
+    }
+
+
+def card_from_json(raw: dict, attachments: Path) -> Card:
+    return Card(
+        content=raw["content"],
+        deck_name=raw["deck_name"],
+        attachments=[
+            Attachment(name, (attachments / name).read_bytes())
+            for name in raw["attachments"]
+        ],
+        path=Path(raw["path"]),
+        direction=Direction(raw["direction"]),
+    )
+
+
+def write_plan(base: Path, plan: Plan):
+    """replaces any plan that was there, with all its done marks"""
+    at = path_of(base)
+    shutil.rmtree(at, ignore_errors=True)
+    (at / "attachments").mkdir(parents=True)
+    operations = []
+    cards: list[Card] = []
+    for operation in plan.operations:
+        match operation:
+            case ("update", id, card, missing):
+                operations.append(
+                    {
+                        "kind": "update",
+                        "id": id,
+                        "card": card_as_json(card),
+                        "missing": [a.file_name for a in missing],
+                    }
+                )
+                cards.append(card)
+            case ("delete", id):
+                operations.append({"kind": "delete", "id": id})
+            case ("create", card):
+                operations.append({"kind": "create", "card": card_as_json(card)})
+                cards.append(card)
+    for card in cards:
+        for attachment in card.attachments:
+            attachment_at = at / "attachments" / attachment.file_name
+            if not attachment_at.exists():
+                attachment_at.write_bytes(attachment.binary_data)
+    raw = {
+        "decks": plan.decks,
+        "operations": operations,
+        "done": sorted(plan.done),
+        "created": plan.created,
+    }
+    # NOTE attachments first, so that there is no plan without its attachments
+    write_compacted(at / "plan.json", at / "done.journal", json.dumps(raw))
+
+
+def read_plan(base: Path) -> None | Plan:
+    """includes the done marks, see mark_done, None if there is no plan"""
+    at = path_of(base)
+    if not exists(base):
+        return None
+    raw = json.loads((at / "plan.json").read_text())
+    operations: list[Operation] = []
+    for operation in raw["operations"]:
+        match operation:
+            case {"kind": "update", "id": str(id), "card": card, "missing": missing}:
+                card = card_from_json(card, at / "attachments")
+                missing = [a for a in card.attachments if a.file_name in missing]
+                operations.append(("update", id, card, missing))
+            case {"kind": "delete", "id": str(id)}:
+                operations.append(("delete", id))
+            case {"kind": "create", "card": card}:
+                operations.append(("create", card_from_json(card, at / "attachments")))
+            case _:
+                assert False, operation
+    # NOTE there is no done.json, the journal holds all marks on top of the ones in plan.json
+    marks = read_journaled(at / "done.json", at / "done.journal")
+    done = set(raw["done"]) | {int(i) for i in marks}
+    return Plan(raw["decks"], operations, done, raw["created"])
+
+
+def mark_done(base: Path, indices: list[int]):
+    append_journal(path_of(base) / "done.journal", {str(i): True for i in indices})
+
+
+def remove_plan(base: Path):
+    shutil.rmtree(path_of(base), ignore_errors=True)
@@ -1,9 +1,24 @@
+import json
+from functools import lru_cache
+from hashlib import sha256
 from pathlib import Path
 from subprocess import CalledProcessError, run
+from threading import Thread
 
-from flask import Flask, current_app, redirect, url_for
+from flask import (
+    Flask,
+    Response,
+    current_app,
+    make_response,
+    redirect,
+    request,
+    send_from_directory,
+    url_for,
+)
 
 import cman.paths
+from cman import workers
+from cman.watch import Watcher
 
 template_path = Path(__file__).parent / "preview-template.html"
 template_path = template_path.absolute()
@@ -19,32 +34,40 @@ def index():
 @app.route("/preview")
 def preview():
     # NOTE we read the time _before_ we use it, so worst case it's old, but never new
-    path = get_most_recent_md(current_app.config["watch_folder"])
+    path = current_app.config["watcher"].latest.path
     if path is None:
         return "n/a"
-    stat = path.stat()
-    name = path.relative_to(current_app.config["watch_folder"])
+    mtime = path.stat().st_mtime
+    response = make_response(render(current_app.config["watch_folder"], path, mtime))
+    response.set_etag(sha256(f"{path}:{mtime}".encode()).hexdigest())
+    # NOTE the browser may keep it, but has to ask, then it's a 304 if nothing changed
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+@lru_cache(maxsize=16)
+def render(folder: Path, path: Path, mtime: float) -> str:
+    """cached by mtime, a change of the file is a new key"""
+    name = path.relative_to(folder)
+    options = [
+        # NOTE served by us from /katex, see katex() below
+        "--katex=/katex/",
+        f"--metadata=pagetitle={name}",
+        # adapted from 'pandoc -D html'
+        f"--template={template_path}",
+        f"--variable=preview_name:{name}",
+        # to find images relative to the markdown file, see files() below
+        f"--variable=preview_base:/files/{name.parent}/",
+        f"--variable=mtime:{mtime}",
+    ]
+    if workers.pool is not None:
+        try:
+            return workers.pool.convert(path.read_text(), "markdown", "html", options)
+        except workers.PandocError as e:
+            return str(e)
     try:
         result = run(
-            [
-                "pandoc",
-                str(path),
-                # needs to be local, because --self-contained copies it everytime
-                # (using https://cdn.jsdelivr.net/npm/katex@0.16.4/dist/ will rate-limit)
-                f"--katex={cman.paths.katex}",
-                f"--metadata=pagetitle={name}",
-                # to find images relative to the markdown file
-                f"--resource-path={path.parent}",
-                # embeds images, and even katex
-                # plus output is a full html document
-                # (otherwise it's a html sub-tree)
-                "--self-contained",
-                # adapted from 'pandoc -D html'
-                f"--template={template_path}",
-                f"--variable=preview_name:{name}",
-                f"--variable=mtime:{stat.st_mtime}",
-                "--to=html",
-            ],
+            ["pandoc", str(path), *options, "--to=html"],
             check=True,
             text=True,
             capture_output=True,
@@ -54,24 +77,66 @@ def preview():
         return e.stdout + e.stderr
 
 
+def prerender(folder: Path, watcher: Watcher):
+    """render changes as they happen, so that the reload they trigger is instant"""
+    mtime = -1.0
+    while True:
+        latest = watcher.wait(mtime, timeout=60)
+        if latest.path is None or latest.mtime <= mtime:
+            continue
+        mtime = latest.mtime
+        try:
+            render(folder, latest.path, latest.path.stat().st_mtime)
+        except OSError:
+            # NOTE gone already, the next change will come
+            pass
+
+
+@app.route("/katex/<path:name>")
+def katex(name: str):
+    # NOTE not --self-contained anymore, so that pandoc doesnt need to embed it every time
+    # and local, because https://cdn.jsdelivr.net/npm/katex@0.16.4/dist/ will rate-limit
+    # the distribution does not change while we run, the browser can keep it
+    return send_from_directory(cman.paths.katex, name, max_age=24 * 60 * 60)
+
+
+@app.route("/files/<path:name>")
+def files(name: str):
+    # NOTE images can change, with max_age=0 the browser revalidates with the etag
+    return send_from_directory(current_app.config["watch_folder"], name, max_age=0)
+
+
 @app.route("/mtime")
 def mtime():
-    path = get_most_recent_md(current_app.config["watch_folder"])
-    if path is None:
-        return {"mtime": -1}
-    stat = path.stat()
-    return {"mtime": stat.st_mtime}
+    return {"mtime": current_app.config["watcher"].latest.mtime}
+
+
+@app.route("/events")
+def events():
+    """server-sent events with the mtime of the most recent file, whenever it changes"""
+    watcher: Watcher = current_app.config["watcher"]
 
+    def stream():
+        mtime = -1.0
+        while True:
+            latest = watcher.wait(mtime, timeout=15)
+            if latest.mtime > mtime:
+                mtime = latest.mtime
+                yield f"data: {json.dumps({'mtime': mtime})}\n\n"
+            else:
+                # NOTE lets us notice when the browser is gone
+                yield ": keep-alive\n\n"
 
-def get_most_recent_md(folder: Path) -> None | Path:
-    candidates = folder.glob("**/*.md")
-    candidates = sorted(candidates, key=lambda c: c.stat().st_mtime)
-    if len(candidates) == 0:
-        return None
-    return candidates[-1]
+    return Response(
+        stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
 
 
 def main(watch_folder: Path = Path("./data")):
     print("See https://katex.org/docs/supported.html for katex features.")
+    watcher = Watcher(watch_folder)
+    watcher.start()
     app.config["watch_folder"] = watch_folder
-    app.run()
+    app.config["watcher"] = watcher
+    Thread(target=prerender, args=(watch_folder, watcher), daemon=True).start()
+    app.run(threaded=True)
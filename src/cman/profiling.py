@@ -0,0 +1,208 @@
+"""
+optional instrumentation, see 'cman --profile'
+spans record wall and cpu time of phases, counters sum up calls, seconds, and bytes of things like requests
+the result is a json summary, and a trace for chrome://tracing or https://ui.perfetto.dev
+when not enabled, a span is a global lookup and an empty context manager
+"""
+
+from __future__ import annotations
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+# NOTE upper bounds in ms, for latency histograms
+buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+
+@dataclass
+class Totals:
+    calls: int = 0
+    seconds: float = 0
+    cpu: float = 0
+    bytes: int = 0
+    # NOTE calls per bucket, the last one is for everything slower
+    histogram: list[int] = field(default_factory=lambda: [0] * (len(buckets) + 1))
+
+    def add(self, other: Totals):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.cpu += other.cpu
+        self.bytes += other.bytes
+        self.histogram = [a + b for a, b in zip(self.histogram, other.histogram)]
+
+    def as_json(self, with_histogram: bool) -> dict:
+        result: dict[str, Any] = {
+            "calls": self.calls,
+            "seconds": round(self.seconds, 6),
+        }
+        if self.cpu > 0:
+            result["cpu"] = round(self.cpu, 6)
+        if self.bytes > 0:
+            result["bytes"] = self.bytes
+        if with_histogram:
+            labels = [f"<={b}ms" for b in buckets] + [f">{buckets[-1]}ms"]
+            result["histogram"] = {
+                label: n for label, n in zip(labels, self.histogram) if n > 0
+            }
+        return result
+
+
+@dataclass
+class Records:
+    """what a process recorded, it can be sent from workers to their parent"""
+
+    spans: dict[str, Totals] = field(default_factory=dict)
+    counters: dict[str, Totals] = field(default_factory=dict)
+    # NOTE complete events for the chrome trace, times are absolute perf_counter seconds
+    events: list[dict] = field(default_factory=list)
+
+    def merge(self, other: Records):
+        for name, totals in other.spans.items():
+            self.spans.setdefault(name, Totals()).add(totals)
+        for name, totals in other.counters.items():
+            self.counters.setdefault(name, Totals()).add(totals)
+        self.events.extend(other.events)
+
+
+class Profiler:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_cpu = time.process_time()
+        self.lock = threading.Lock()
+        self.records = Records()
+
+    def add_span(self, name: str, start: float, wall: float, cpu: float, args: dict):
+        event = {
+            "name": name,
+            "ph": "X",
+            "ts": start,
+            "dur": wall,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args | {"cpu_ms": round(cpu * 1000, 3)},
+        }
+        with self.lock:
+            totals = self.records.spans.setdefault(name, Totals())
+            totals.calls += 1
+            totals.seconds += wall
+            totals.cpu += cpu
+            self.records.events.append(event)
+
+    def add_count(self, name: str, seconds: float, bytes: int):
+        bucket = bisect.bisect_left(buckets, seconds * 1000)
+        with self.lock:
+            totals = self.records.counters.setdefault(name, Totals())
+            totals.calls += 1
+            totals.seconds += seconds
+            totals.bytes += bytes
+            totals.histogram[bucket] += 1
+
+    def take(self) -> Records:
+        with self.lock:
+            records, self.records = self.records, Records()
+        return records
+
+    def merge(self, records: Records):
+        with self.lock:
+            self.records.merge(records)
+
+    def summary(self) -> dict:
+        with self.lock:
+            return {
+                "seconds": round(time.perf_counter() - self.started, 6),
+                # NOTE of this process only, workers are in their spans
+                "cpu": round(time.process_time() - self.started_cpu, 6),
+                "spans": {
+                    name: totals.as_json(False)
+                    for name, totals in sorted(self.records.spans.items())
+                },
+                "counters": {
+                    name: totals.as_json(True)
+                    for name, totals in sorted(self.records.counters.items())
+                },
+            }
+
+    def trace(self) -> dict:
+        with self.lock:
+            events = [
+                event
+                | {
+                    "ts": round((event["ts"] - self.started) * 1e6, 1),
+                    "dur": round(event["dur"] * 1e6, 1),
+                }
+                for event in self.records.events
+            ]
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self, at: Path):
+        """the summary at at, and the trace next to it, returns the path of the trace"""
+        trace = at.with_suffix(".trace.json")
+        at.write_text(json.dumps(self.summary(), indent=4) + "\n")
+        trace.write_text(json.dumps(self.trace()))
+        return trace
+
+
+profiler: None | Profiler = None
+
+
+def enable():
+    global profiler
+    if profiler is None:
+        profiler = Profiler()
+
+
+def is_enabled() -> bool:
+    return profiler is not None
+
+
+@contextmanager
+def span(name: str, **args: Any) -> Iterator[None]:
+    """a phase, it shows in the trace, and its wall and cpu time add up by name"""
+    if profiler is None:
+        yield
+        return
+    start = time.perf_counter()
+    # NOTE cpu of this thread, spans run concurrently on threads
+    start_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        # NOTE the profiler could have been replaced, see collected
+        if profiler is not None:
+            profiler.add_span(
+                name,
+                start,
+                time.perf_counter() - start,
+                time.thread_time() - start_cpu,
+                args,
+            )
+
+
+def count(name: str, seconds: float, bytes: int = 0):
+    """one more of something that took seconds, like a request or a pandoc process"""
+    if profiler is not None:
+        profiler.add_count(name, seconds, bytes)
+
+
+def merge(records: Records):
+    if profiler is not None:
+        profiler.merge(records)
+
+
+def collected[R](f: Callable[..., R], *args: Any) -> tuple[R, Records]:
+    """
+    f(*args) in a worker process, with what it recorded, for the parent to merge
+    perf_counter is system wide on linux, so times of workers and parent line up
+    """
+    global profiler
+    profiler = Profiler()
+    result = f(*args)
+    return result, profiler.take()
@@ -0,0 +1,165 @@
+"""
+render all cards into a static html site, see 'cman render'
+a page per card and direction, an index per deck, and one shared copy of katex
+a card is only rendered again when its markdown, its images, or the template changed
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from collections.abc import Set
+from functools import partial
+from html import escape
+from pathlib import Path
+
+import cman.paths
+from cman.cache import Cache, key_of, markdown_from_str
+from cman.data import map_parallel
+from cman.markdown import Direction, Engine, pandoc_version
+
+template_path = Path(__file__).parent / "render-template.html"
+template_path = template_path.absolute()
+
+
+def render(
+    base: Path,
+    decks: Set[str],
+    out: Path,
+    cache: None | Cache = None,
+    engine: Engine = Engine.pandoc,
+    jobs: int = 1,
+):
+    out.mkdir(parents=True, exist_ok=True)
+    if not (out / "katex").exists():
+        shutil.copytree(cman.paths.katex, out / "katex")
+
+    # NOTE path -> key and directions of what was rendered last time
+    state_path = out / "render.json"
+    state: dict[str, dict] = (
+        json.loads(state_path.read_text()) if state_path.exists() else {}
+    )
+
+    paths = sorted(
+        path.relative_to(base) for deck in decks for path in (base / deck).rglob("*.md")
+    )
+    items = [(path, state.get(str(path), {}).get("key")) for path in paths]
+    f = partial(render_card, base, out, cache, engine)
+    rendered = dict(zip(paths, map_parallel(f, items, jobs, "render cards")))
+
+    for name in set(state) - {str(path) for path in paths}:
+        for direction in state[name]["directions"]:
+            page_of(out, Path(name), Direction(direction)).unlink(missing_ok=True)
+
+    state = {
+        str(path): {"key": key, "directions": [d.value for d in directions]}
+        for path, (key, directions) in rendered.items()
+    }
+    state_path.write_text(json.dumps(state, indent=4))
+
+    for deck in sorted(decks):
+        write_deck_index(
+            out, deck, {p: d for p, (_, d) in rendered.items() if p.parts[0] == deck}
+        )
+    write_index(out, decks, rendered)
+
+
+def render_card(
+    base: Path,
+    out: Path,
+    cache: None | Cache,
+    engine: Engine,
+    path: Path,
+    old_key: None | str,
+) -> tuple[str, list[Direction]]:
+    """renders unless the key is still old_key, returns the new key and the rendered directions"""
+    text = (base / path).read_text()
+    markdown = markdown_from_str(cache, text, engine)
+    images = sorted(set(markdown.get_image_paths()))
+
+    directions = [Direction.forward]
+    if markdown.has_reverse_prompt():
+        directions.append(Direction.backward)
+
+    stamps = []
+    for image in images:
+        stat = (base / path.parent / image).stat()
+        stamps.append(f"{image}:{stat.st_size}:{stat.st_mtime_ns}")
+    key = key_of(
+        "render",
+        pandoc_version(),
+        template_path.read_text(),
+        str(path),
+        text,
+        *stamps,
+    )
+    if key == old_key and all(page_of(out, path, d).exists() for d in directions):
+        return key, directions
+
+    for image in images:
+        target = out / path.parent / image
+        target.parent.mkdir(parents=True, exist_ok=True)
+        shutil.copy2(base / path.parent / image, target)
+
+    for direction in Direction:
+        page = page_of(out, path, direction)
+        if direction not in directions:
+            page.unlink(missing_ok=True)
+            continue
+        page.parent.mkdir(parents=True, exist_ok=True)
+        options = [
+            f"--katex={os.path.relpath(out / 'katex', page.parent)}/",
+            f"--metadata=pagetitle={path} {direction.value}",
+            f"--template={template_path}",
+            f"--variable=index:{os.path.relpath(out / path.parts[0] / 'index.html', page.parent)}",
+        ]
+        html = markdown.oriented(direction).maybe_prompted().as_html(options)
+        page.write_text(html)
+
+    return key, directions
+
+
+def page_of(out: Path, path: Path, direction: Direction) -> Path:
+    return out / path.with_suffix(f".{direction.value}.html")
+
+
+def write_deck_index(out: Path, deck: str, cards: dict[Path, list[Direction]]):
+    lines = [f"<h1>{escape(deck)}</h1>", "<ul>"]
+    for path, directions in sorted(cards.items()):
+        links = ", ".join(
+            f'<a href="{escape(str(page_of(out, path, d).relative_to(out / deck)))}">{d.value}</a>'
+            for d in directions
+        )
+        lines.append(f"<li>{escape(str(path.relative_to(deck)))}: {links}</li>")
+    lines.append("</ul>")
+    write_page(out / deck / "index.html", deck, lines)
+
+
+def write_index(
+    out: Path, decks: Set[str], rendered: dict[Path, tuple[str, list[Direction]]]
+):
+    lines = ["<h1>decks</h1>", "<ul>"]
+    for deck in sorted(decks):
+        count = sum(len(d) for p, (_, d) in rendered.items() if p.parts[0] == deck)
+        lines.append(
+            f'<li><a href="{escape(deck)}/index.html">{escape(deck)}</a>: {count} cards</li>'
+        )
+    lines.append("</ul>")
+    write_page(out / "index.html", "decks", lines)
+
+
+def write_page(at: Path, title: str, lines: list[str]):
+    at.parent.mkdir(parents=True, exist_ok=True)
+    at.write_text(
+        "\n".join(
+            [
+                "<!DOCTYPE html>",
+                '<html><head><meta charset="utf-8" />',
+                f"<title>{escape(title)}</title></head><body>",
+                *lines,
+                "</body></html>",
+                "",
+            ]
+        )
+    )
@@ -0,0 +1,86 @@
+"""
+a part of the cards, to sync only what was touched
+all paths are relative to the base of the cards
+"""
+
+from __future__ import annotations
+
+import subprocess
+from collections.abc import Set
+from dataclasses import dataclass, field
+from pathlib import Path
+
+
+@dataclass
+class Scope:
+    # folders include everything below them, a deck is the folder of its name
+    folders: set[Path] = field(default_factory=set)
+    # single markdown files, they don't need to exist, then they were removed
+    files: set[Path] = field(default_factory=set)
+
+    @classmethod
+    def from_paths(cls, base: Path, paths: list[Path]):
+        """paths as given on the command line, relative to the working directory"""
+        scope = cls()
+        for path in paths:
+            path = path.resolve().relative_to(base.resolve())
+            if (base / path).is_dir():
+                scope.folders.add(path)
+            else:
+                scope.files.add(path)
+        return scope
+
+    @classmethod
+    def from_git(cls, base: Path, ref: str):
+        """
+        everything that changed since ref, including uncommitted and untracked files
+        a rename is a removal and an addition, without --no-renames git would hide the removal
+        """
+        changed = git_lines(
+            base, "diff", "--name-only", "--no-renames", "--relative", ref
+        )
+        changed += git_lines(base, "ls-files", "--others", "--exclude-standard")
+        scope = cls()
+        for path in map(Path, changed):
+            if path.suffix == ".md":
+                scope.files.add(path)
+                continue
+            # NOTE images are referenced relative to the markdown
+            # so any markdown in the same folder or above could use this file
+            for folder in path.parents[:-1]:
+                scope.files.update(
+                    p.relative_to(base) for p in (base / folder).glob("*.md")
+                )
+        return scope
+
+    def __or__(self, other: Scope) -> Scope:
+        return Scope(self.folders | other.folders, self.files | other.files)
+
+    def contains(self, path: Path) -> bool:
+        return path in self.files or any(
+            folder == path or folder in path.parents for folder in self.folders
+        )
+
+    def whole_decks(self, decks: Set[str]) -> set[str]:
+        """decks that are completely in scope"""
+        return {deck for deck in decks if self.contains(Path(deck))}
+
+    def markdown_paths(self, base: Path, decks: Set[str]) -> list[Path]:
+        """existing markdowns in scope, in the given decks, relative to base"""
+        paths = {
+            path.relative_to(base)
+            for folder in self.folders
+            for path in (base / folder).rglob("*.md")
+        }
+        paths |= {path for path in self.files if (base / path).is_file()}
+        return sorted(path for path in paths if path.parts[0] in decks)
+
+
+def git_lines(base: Path, *args: str) -> list[str]:
+    result = subprocess.run(
+        ["git", "-C", str(base), *args],
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return [line for line in result.stdout.splitlines() if line != ""]
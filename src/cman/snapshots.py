@@ -0,0 +1,249 @@
+"""
+a deduplicated store of backups, see 'cman snapshot'
+every version of a card, and every attachment, is stored once as an object named by its hash
+a snapshot is only a small manifest of hashes, so the store grows with the changes, not with the days
+"""
+
+from __future__ import annotations
+
+import datetime
+import gzip
+import json
+import os
+import threading
+from collections.abc import Collection, Mapping
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from hashlib import sha256
+from pathlib import Path
+
+from serde import serde
+from serde.json import from_json, to_json
+from tqdm import tqdm
+
+from cman import api
+from cman.api import ApiError, MochiClient, raw_list_cards, raw_retrieve_attachment
+from cman.backup import attachment_re
+from cman.executor import Report, run_adaptive
+
+
+@serde
+class Snapshot:
+    date: str
+    # deck id -> card id -> hash of the raw card
+    decks: dict[str, dict[str, str]]
+    # deck id -> deck name, at the time of the snapshot
+    names: dict[str, str]
+    # card id -> attachment name -> hash of the data
+    attachments: dict[str, dict[str, str]]
+
+    def hashes(self) -> set[str]:
+        return {h for cards in self.decks.values() for h in cards.values()} | {
+            h for names in self.attachments.values() for h in names.values()
+        }
+
+
+@dataclass
+class Store:
+    folder: Path
+
+    def object_path(self, hash: str) -> Path:
+        return self.folder / "objects" / hash[:2] / hash
+
+    def put(self, data: bytes) -> str:
+        hash = sha256(data).hexdigest()
+        path = self.object_path(hash)
+        if not path.exists():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # NOTE write and rename, so that an object is never partial
+            tmp = path.with_name(f"{hash}.{os.getpid()}.{threading.get_ident()}.tmp")
+            tmp.write_bytes(gzip.compress(data))
+            tmp.replace(path)
+        return hash
+
+    def get(self, hash: str) -> bytes:
+        data = gzip.decompress(self.object_path(hash).read_bytes())
+        assert sha256(data).hexdigest() == hash, f"object {hash} is corrupt"
+        return data
+
+    def names(self) -> list[str]:
+        """oldest first"""
+        return sorted(p.stem for p in (self.folder / "snapshots").glob("*.json"))
+
+    def read(self, name: str) -> Snapshot:
+        return from_json(
+            Snapshot, (self.folder / "snapshots" / f"{name}.json").read_text()
+        )
+
+    def write(self, name: str, snapshot: Snapshot):
+        path = self.folder / "snapshots" / f"{name}.json"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(to_json(snapshot, indent=4))
+
+    def prune(self, keep: Collection[str]) -> tuple[int, int]:
+        """removes snapshots not in keep, and objects no kept snapshot uses"""
+        removed = [name for name in self.names() if name not in keep]
+        for name in removed:
+            (self.folder / "snapshots" / f"{name}.json").unlink()
+        used = set().union(*(self.read(name).hashes() for name in keep))
+        objects = 0
+        for path in (self.folder / "objects").glob("*/*"):
+            if path.name not in used:
+                path.unlink()
+                objects += 1
+        return len(removed), objects
+
+
+def take(
+    store: Store,
+    client: MochiClient,
+    decks: Mapping[str, str],  # deck name -> mochi deck id
+    attachments: bool = False,
+) -> str:
+    """returns the name of the new snapshot"""
+    now = datetime.datetime.now()
+    names = store.names()
+    previous = store.read(names[-1]) if len(names) > 0 else None
+    progress = tqdm(desc="snapshot cards")
+
+    def f(deck_id: str) -> dict[str, str]:
+        cards = {}
+        for card in raw_list_cards(client, deck_id):
+            cards[card["id"]] = store.put(json.dumps(card, sort_keys=True).encode())
+            progress.update()
+        return cards
+
+    with progress, ThreadPoolExecutor(max(1, len(decks))) as executor:
+        cards = dict(zip(decks.values(), executor.map(f, decks.values())))
+
+    snapshot = Snapshot(
+        date=now.isoformat(timespec="seconds"),
+        decks=cards,
+        names={id: name for name, id in decks.items()},
+        attachments={},
+    )
+    if attachments:
+        snapshot.attachments = take_attachments(store, client, snapshot, previous)
+
+    name = now.strftime("%Y-%m-%dT%H-%M-%S")
+    store.write(name, snapshot)
+    return name
+
+
+def take_attachments(
+    store: Store, client: MochiClient, snapshot: Snapshot, previous: None | Snapshot
+) -> dict[str, dict[str, str]]:
+    wanted = [
+        (card_id, name)
+        for cards in snapshot.decks.values()
+        for card_id, hash in cards.items()
+        for name in sorted(
+            set(attachment_re.findall(json.loads(store.get(hash))["content"]))
+        )
+    ]
+
+    def f(item: tuple[str, str]) -> None | str:
+        card_id, name = item
+        # NOTE attachments are not changed in place, same card and name is the same data
+        if previous is not None and name in previous.attachments.get(card_id, {}):
+            return previous.attachments[card_id][name]
+        try:
+            return store.put(raw_retrieve_attachment(client, card_id, name))
+        except ApiError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    result: dict[str, dict[str, str]] = {}
+    with ThreadPoolExecutor(8) as executor:
+        hashes = executor.map(f, wanted)
+        for (card_id, name), hash in tqdm(
+            zip(wanted, hashes), total=len(wanted), desc="snapshot attachments"
+        ):
+            if hash is not None:
+                result.setdefault(card_id, {})[name] = hash
+    return result
+
+
+@dataclass
+class SnapshotDiff:
+    # deck id -> card ids
+    added: dict[str, list[str]]
+    removed: dict[str, list[str]]
+    changed: dict[str, list[str]]
+
+    @classmethod
+    def from_snapshots(cls, old: Snapshot, new: Snapshot):
+        added, removed, changed = {}, {}, {}
+        for deck_id in sorted(set(old.decks) | set(new.decks)):
+            a, b = old.decks.get(deck_id, {}), new.decks.get(deck_id, {})
+            added[deck_id] = sorted(set(b) - set(a))
+            removed[deck_id] = sorted(set(a) - set(b))
+            changed[deck_id] = sorted(id for id in set(a) & set(b) if a[id] != b[id])
+        return cls(added, removed, changed)
+
+    def print_summary(self, names: Mapping[str, str]):
+        for deck_id in self.added:
+            name = names.get(deck_id, deck_id)
+            for id in self.added[deck_id]:
+                print(f"{name}: added {id}")
+            for id in self.removed[deck_id]:
+                print(f"{name}: removed {id}")
+            for id in self.changed[deck_id]:
+                print(f"{name}: changed {id}")
+            print(
+                f"{name}: {len(self.added[deck_id])} added, "
+                f"{len(self.removed[deck_id])} removed, "
+                f"{len(self.changed[deck_id])} changed"
+            )
+
+
+def retained(names: list[str], last: int, daily: int, weekly: int) -> set[str]:
+    """
+    the last snapshots, and the newest of each of the last days and weeks
+    names sort by time, and start with the iso date
+    """
+    keep = set(names[-last:] if last > 0 else [])
+    days: dict[str, str] = {}
+    weeks: dict[tuple[int, int], str] = {}
+    for name in names:
+        date = datetime.date.fromisoformat(name[:10])
+        days[name[:10]] = name
+        weeks[date.isocalendar()[:2]] = name
+    keep |= set(sorted(days.values())[-daily:] if daily > 0 else [])
+    keep |= set(sorted(weeks.values())[-weekly:] if weekly > 0 else [])
+    return keep
+
+
+def restore(
+    store: Store,
+    client: MochiClient,
+    snapshot: Snapshot,
+    deck_ids: Mapping[str, str],  # deck id in the snapshot -> deck id to restore into
+    report: Report,
+) -> int:
+    """creates new cards, with new ids, returns how many"""
+    cards = [
+        (target, card_id, hash)
+        for deck_id, target in deck_ids.items()
+        for card_id, hash in snapshot.decks[deck_id].items()
+    ]
+
+    def run(card: tuple[str, str, str]) -> api.Card:
+        target, card_id, hash = card
+        content = json.loads(store.get(hash))["content"]
+        attachments = [
+            api.Attachment(name, store.get(h))
+            for name, h in snapshot.attachments.get(card_id, {}).items()
+        ]
+        return api.create_card(client, target, content, attachments)
+
+    def describe(card: tuple[str, str, str]) -> tuple[str, str]:
+        return "create", f"restore {card[1]}"
+
+    count = 0
+    for _ in tqdm(
+        run_adaptive(cards, run, describe, report), total=len(cards), desc="restore"
+    ):
+        count += 1
+    return count
@@ -3,51 +3,102 @@ from __future__ import annotations
 from collections.abc import Iterator, Mapping
 from dataclasses import dataclass
 from pathlib import Path
+from threading import Event
 
-from requests.auth import HTTPBasicAuth
+from cman import api, profiling
+from cman.data import Card, Meta, Remote, content_hash
+from cman.executor import Report, run_adaptive
+from cman.plan import Operation
 
-from cman import api
-from cman.data import Card, Meta
 
-
-def states_from_apply_diff(
-    auth: HTTPBasicAuth,
+def states_from_operations(
+    client: api.MochiClient,
     decks: Mapping[str, str],  # deck name -> mochi deck id
-    state: dict[str, api.Card],
-    diff: MochiDiff,
+    operations: dict[int, Operation],
     meta: dict[Path, Meta],
-) -> Iterator[tuple[dict[str, api.Card], dict[Path, Meta]]]:
-    for id, card in diff.changed.items():
-        u = api.update_card(
-            auth,
-            api.Card(
-                id=id,
-                content=card.content,
-                deck_id=decks[card.deck_name],
-            ),
-            attachments=card.attachments,
-        )
-        state[u.id] = u
-        yield state, meta
+    remote: dict[str, Remote],
+    report: Report,
+    max_in_flight: int = 8,
+    stop: None | Event = None,
+) -> Iterator[tuple[int, dict[Path, Meta], dict[str, None | Remote]]]:
+    """
+    applies operations concurrently, yields after each completed one, see cman.plan
+    meta, and the remote snapshot are updated in place
+    what is yielded is the key of the operation, and the entries of meta and remote that changed, None if removed
+    operations that fail are in the report, and not in meta or remote
+    when stop is set, operations in flight complete, the others are left as they are
+    """
 
-    for card in diff.removed:
-        api.delete_card(auth, card.id)
-        state.pop(card.id)
-        yield state, meta
+    def run(item: tuple[int, Operation]) -> None | api.Card:
+        _, operation = item
+        with profiling.span(f"apply {operation[0]}"):
+            match operation:
+                case ("update", id, card, missing):
+                    return api.update_card(
+                        client,
+                        api.Card(
+                            id=id,
+                            content=card.content,
+                            deck_id=decks[card.deck_name],
+                        ),
+                        attachments=missing,
+                    )
+                case ("delete", id):
+                    try:
+                        api.delete_card(client, id)
+                    except api.ApiError as e:
+                        # NOTE gone already, like when it was deleted before a sync was interrupted
+                        if e.status_code != 404:
+                            raise
+                    return None
+                case ("create", card):
+                    return api.create_card(
+                        client, decks[card.deck_name], card.content, card.attachments
+                    )
 
-    for card in diff.new:
-        u = api.create_card(auth, decks[card.deck_name], card.content, card.attachments)
-        meta.setdefault(card.path, Meta(None, None)).set_by_direction(
-            card.direction, u.id
-        )
-        state[u.id] = u
-        yield state, meta
+    def describe(item: tuple[int, Operation]) -> tuple[str, str]:
+        match item[1]:
+            case ("update", id, card, _):
+                return "update", f"update {id} from {card.path}"
+            case ("delete", id):
+                return "delete", f"delete {id}"
+            case ("create", card):
+                return "create", f"create from {card.path}"
+
+    items = list(operations.items())
+    for (i, operation), u in run_adaptive(
+        items, run, describe, report, max_in_flight, stop=stop
+    ):
+        match operation, u:
+            case ("update", _, card, _), api.Card():
+                # NOTE the remote keeps attachments that are not referenced anymore
+                uploaded = set(remote.get(u.id, Remote([])).attachments)
+                uploaded |= {a.file_name for a in card.attachments}
+                remote[u.id] = Remote(
+                    sorted(uploaded), u.deck_id, content_hash(u.content)
+                )
+                yield i, {}, {u.id: remote[u.id]}
+            case ("delete", id), None:
+                remote.pop(id, None)
+                yield i, {}, {id: None}
+            case ("create", card), api.Card():
+                meta.setdefault(card.path, Meta(None, None)).set_by_direction(
+                    card.direction, u.id
+                )
+                remote[u.id] = Remote(
+                    sorted(a.file_name for a in card.attachments),
+                    u.deck_id,
+                    content_hash(u.content),
+                )
+                yield i, {card.path: meta[card.path]}, {u.id: remote[u.id]}
+            case _:
+                assert False, operation
 
 
 @dataclass
 class MochiDiff:
     changed: dict[str, Card]
-    removed: list[api.Card]
+    removed: list[str]  # card ids
     new: list[Card]
 
     @classmethod
@@ -68,7 +119,30 @@ class MochiDiff:
             if (remote[id].content != card.content)
             or (remote[id].deck_id != decks[card.deck_name])
         }
-        removed = [c for c in remote.values() if c.id not in existing]
+        removed = [id for id in remote if id not in existing]
+        return cls(changed, removed, new)
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        snapshot: dict[str, Remote],
+        existing: dict[str, Card],
+        new: list[Card],
+        decks: Mapping[str, str],  # deck name -> mochi deck id
+    ):
+        """like from_states, but against what we know the remote has, without listing it"""
+        assert all(snapshot[id].is_complete() for id in existing)
+        changed = {
+            id: card
+            for id, card in existing.items()
+            if (snapshot[id].content_hash != content_hash(card.content))
+            or (snapshot[id].deck_id != decks[card.deck_name])
+        }
+        removed = [
+            id
+            for id, remote in snapshot.items()
+            if id not in existing and remote.deck_id in decks.values()
+        ]
         return cls(changed, removed, new)
 
     def count(self) -> int:
@@ -0,0 +1,134 @@
+"""
+an optional sqlite store for meta and the remote snapshot, instead of meta.json and remote.json
+it is used when there is a state.sqlite in the base of the cards, see 'cman state'
+every write is one transaction, and lookups by path, card id, deck, or content hash are indexed
+"""
+
+from __future__ import annotations
+
+import json
+import sqlite3
+from collections.abc import Iterator, Mapping
+from contextlib import closing, contextmanager
+from pathlib import Path
+
+from cman.data import Meta, Remote
+from cman.markdown import Direction
+
+schema = """
+create table if not exists meta (
+    path text primary key,
+    deck text not null,
+    forward text unique,
+    backward text unique
+);
+create index if not exists meta_deck on meta (deck);
+create table if not exists remote (
+    id text primary key,
+    deck_id text,
+    content_hash text,
+    attachments text not null -- json list of names
+);
+create index if not exists remote_deck_id on remote (deck_id);
+create index if not exists remote_content_hash on remote (content_hash);
+"""
+
+
+def path_of(base: Path) -> Path:
+    return base / "state.sqlite"
+
+
+def exists(base: Path) -> bool:
+    return path_of(base).exists()
+
+
+@contextmanager
+def transaction(base: Path) -> Iterator[sqlite3.Connection]:
+    with closing(sqlite3.connect(path_of(base))) as db, db:
+        db.executescript(schema)
+        yield db
+
+
+def read_meta(base: Path) -> dict[Path, Meta]:
+    with transaction(base) as db:
+        rows = db.execute("select path, forward, backward from meta")
+        return {Path(path): Meta(forward, backward) for path, forward, backward in rows}
+
+
+def write_meta(base: Path, meta: dict[Path, Meta]):
+    with transaction(base) as db:
+        db.execute("delete from meta")
+        update_meta(db, meta)
+
+
+def append_meta(base: Path, changes: dict[Path, Meta]):
+    with transaction(base) as db:
+        update_meta(db, changes)
+
+
+def update_meta(db: sqlite3.Connection, changes: dict[Path, Meta]):
+    # NOTE clear ids first, the unique constraints would fail while ids move between paths
+    db.executemany(
+        "update meta set forward = null, backward = null where path = ?",
+        [(str(path),) for path in changes],
+    )
+    db.executemany(
+        """
+        insert into meta (path, deck, forward, backward) values (?, ?, ?, ?)
+        on conflict (path) do update set forward = excluded.forward, backward = excluded.backward
+        """,
+        [
+            (str(path), path.parts[0], meta.forward, meta.backward)
+            for path, meta in changes.items()
+        ],
+    )
+
+
+def read_remote(base: Path) -> dict[str, Remote]:
+    with transaction(base) as db:
+        rows = db.execute("select id, deck_id, content_hash, attachments from remote")
+        return {
+            id: Remote(json.loads(attachments), deck_id, content_hash)
+            for id, deck_id, content_hash, attachments in rows
+        }
+
+
+def write_remote(base: Path, remote: dict[str, Remote]):
+    with transaction(base) as db:
+        db.execute("delete from remote")
+        update_remote(db, remote)
+
+
+def append_remote(base: Path, changes: dict[str, None | Remote]):
+    with transaction(base) as db:
+        update_remote(db, changes)
+
+
+def update_remote(db: sqlite3.Connection, changes: Mapping[str, None | Remote]):
+    db.executemany(
+        "delete from remote where id = ?",
+        [(id,) for id, remote in changes.items() if remote is None],
+    )
+    db.executemany(
+        "insert or replace into remote (id, deck_id, content_hash, attachments) values (?, ?, ?, ?)",
+        [
+            (id, r.deck_id, r.content_hash, json.dumps(r.attachments))
+            for id, r in changes.items()
+            if r is not None
+        ],
+    )
+
+
+def find_card(base: Path, card_id: str) -> None | tuple[Path, Direction]:
+    with transaction(base) as db:
+        row = db.execute(
+            "select path, forward = ? from meta where forward = ? or backward = ?",
+            (card_id, card_id, card_id),
+        ).fetchone()
+    match row:
+        case None:
+            return None
+        case (path, is_forward):
+            return Path(path), Direction.forward if is_forward else Direction.backward
+        case _:
+            assert False, row
@@ -1,60 +1,291 @@
-from collections.abc import Mapping
+import random
+import sys
+from collections.abc import Collection, Mapping
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import click
 from tqdm import tqdm
 
-from cman.api import auth_from_token, list_cards
+from cman import api, plan, profiling
+from cman.api import ApiError, MochiClient, list_cards, retrieve_card
+from cman.cache import Cache
 from cman.data import (
+    Card,
     MetaDiff,
+    Remote,
+    append_meta,
+    append_remote,
+    as_flat_meta_state,
+    content_hash,
     get_cards,
     get_synced_meta,
     read_markdowns,
     read_meta,
+    read_remote,
+    snapshot_from_listing,
     write_meta,
+    write_remote,
 )
-from cman.state import MochiDiff, states_from_apply_diff
+from cman.executor import Report, graceful_interrupt
+from cman.images import ImageOptions
+from cman.markdown import Engine
+from cman.plan import Plan
+from cman.scope import Scope
+from cman.state import MochiDiff, states_from_operations
 
 
-def sync(token: str, base: Path, decks: Mapping[str, str]):
-    auth = auth_from_token(token)
+def sync(
+    client: MochiClient,
+    base: Path,
+    decks: Mapping[str, str],
+    cache: None | Cache = None,
+    engine: Engine = Engine.pandoc,
+    jobs: int = 1,
+    connections: int = 8,
+    fast: bool = False,
+    sample: int = 0,
+    scope: None | Scope = None,
+    yes: bool = False,
+    image_options: None | Mapping[str, ImageOptions] = None,
+):
+    """
+    with a scope, only cards in scope are built, diffed, and applied
+    with yes, changes are made without asking
+    the plan is written before it is applied, see cman.plan
+    image_options are per deck, see get_cards
+    """
+    if plan.exists(base):
+        print("The plan of an unfinished sync is replaced, see 'cman sync --resume'.")
+    planned = make_plan(
+        client,
+        base,
+        decks,
+        cache,
+        engine,
+        jobs,
+        fast,
+        sample,
+        scope,
+        yes,
+        image_options,
+    )
+    if len(planned.operations) == 0:
+        plan.remove_plan(base)
+        return
+    if not yes:
+        click.confirm("Continue?", abort=True)
+    plan.write_plan(base, planned)
+    apply(client, base, planned, connections)
+
 
-    markdowns = read_markdowns(base, decks.keys())
-    meta = read_meta(base)
+def make_plan(
+    client: MochiClient,
+    base: Path,
+    decks: Mapping[str, str],
+    cache: None | Cache = None,
+    engine: Engine = Engine.pandoc,
+    jobs: int = 1,
+    fast: bool = False,
+    sample: int = 0,
+    scope: None | Scope = None,
+    yes: bool = False,
+    image_options: None | Mapping[str, ImageOptions] = None,
+) -> Plan:
+    """
+    what sync would do, meta and the remote snapshot are updated on the way
+    with yes, meta changes are made without asking
+    """
 
-    synced_meta = get_synced_meta(markdowns, meta)
-    meta_diff = MetaDiff.from_states(meta, synced_meta)
+    markdowns = read_markdowns(base, decks.keys(), cache, engine, jobs, scope)
+    # NOTE meta out of scope is kept as is, and written back with the scoped meta
+    meta, others = read_meta(base), {}
+    if scope is not None:
+        others = {p: m for p, m in meta.items() if not scope.contains(p)}
+        meta = {p: m for p, m in meta.items() if scope.contains(p)}
+    # NOTE before syncing meta, so that cards of removed files are in scope too
+    scoped_ids = {id for _, _, id in as_flat_meta_state(meta)}
+    other_ids = {id for _, _, id in as_flat_meta_state(others)}
+
+    with profiling.span("sync meta"):
+        synced_meta = get_synced_meta(markdowns, meta)
+        meta_diff = MetaDiff.from_states(meta, synced_meta)
     meta_diff.print_summary()
     if meta_diff.count() > 0:
-        click.confirm("Continue?", abort=True)
-        write_meta(base, synced_meta)
+        if not yes:
+            click.confirm("Continue?", abort=True)
+        write_meta(base, others | synced_meta)
         meta = synced_meta
 
-    existing_cards, new_cards = get_cards(base, markdowns, meta)
+    existing_cards, new_cards = get_cards(
+        base, markdowns, meta, cache, engine, jobs, image_options
+    )
+    if cache is not None:
+        cache.prune()
 
-    remote = {
-        c.id: c
-        for c in tqdm(
-            list_cards(auth),
-            total=len(existing_cards),
-            desc=f"list cards",
-        )
-    }
-    for card in remote.values():
-        assert not card.archived, card.id
-        assert card.trashed is None, card.id
-        assert not card.review_reverse, card.id
-        assert card.template_id is None, card.id
-
-    diff = MochiDiff.from_states(remote, existing_cards, new_cards, decks)
+    # NOTE with a scope, we look at the decks that are completely in scope
+    # and at single cards that are in scope, but never at cards known out of scope
+    whole_deck_ids = list(decks.values())
+    if scope is not None:
+        whole_deck_ids = [decks[d] for d in scope.whole_decks(decks.keys())]
+
+    def in_scope(id: str, deck_id: None | str) -> bool:
+        if scope is None:
+            return True
+        return id not in other_ids and (id in scoped_ids or deck_id in whole_deck_ids)
+
+    snapshot = read_remote(base)
+    diff = None
+    if fast:
+        with profiling.span("diff from snapshot"):
+            diff = diff_from_snapshot(
+                client,
+                {id: r for id, r in snapshot.items() if in_scope(id, r.deck_id)},
+                existing_cards,
+                new_cards,
+                decks,
+                sample,
+            )
+    if diff is None:
+        with profiling.span("list remote"):
+            remote = list_remote(client, whole_deck_ids, len(existing_cards))
+            if scope is not None:
+                remote |= retrieve_remote(client, scoped_ids - set(remote))
+        if scope is not None:
+            remote = {id: c for id, c in remote.items() if in_scope(id, c.deck_id)}
+        for card in remote.values():
+            assert not card.archived, card.id
+            assert card.trashed is None, card.id
+            assert not card.review_reverse, card.id
+            assert card.template_id is None, card.id
+        snapshot = {
+            id: r for id, r in snapshot.items() if not in_scope(id, r.deck_id)
+        } | snapshot_from_listing(remote, snapshot)
+        write_remote(base, snapshot)
+        with profiling.span("mochi diff"):
+            diff = MochiDiff.from_states(remote, existing_cards, new_cards, decks)
     diff.print_summary()
 
-    if diff.count() > 0:
-        click.confirm("Continue?", abort=True)
-        for state, meta in tqdm(
-            states_from_apply_diff(auth, decks, remote, diff, meta),
-            total=diff.count(),
-            desc="sync",
-        ):
-            assert len(state) > 0
+    return Plan.from_diff(diff, dict(decks), snapshot)
+
+
+def apply(client: MochiClient, base: Path, planned: Plan, connections: int = 8):
+    """
+    the operations of the plan that are not done yet, the plan is removed when all are done
+    ctrl-c stops when the operations in flight are done, the rest is left for the next apply
+    """
+    # NOTE as written by make_plan, or as left by an apply that did not finish
+    meta, snapshot = read_meta(base), read_remote(base)
+    remaining = planned.remaining(meta)
+    report = Report()
+    with graceful_interrupt() as stop:
+        try:
+            with profiling.span("apply"):
+                for i, meta_changes, remote_changes in tqdm(
+                    states_from_operations(
+                        client,
+                        planned.decks,
+                        remaining,
+                        meta,
+                        snapshot,
+                        report,
+                        connections,
+                        stop,
+                    ),
+                    total=len(remaining),
+                    desc="sync",
+                ):
+                    # NOTE appending to journals is cheap, a full write per card is quadratic
+                    append_meta(base, meta_changes)
+                    append_remote(base, remote_changes)
+                    # NOTE after meta, a create that is in meta is done anyway, see Plan.remaining
+                    plan.mark_done(base, [i])
+        finally:
             write_meta(base, meta)
+            write_remote(base, snapshot)
+    report.print_summary()
+
+    left = len(remaining) - report.done.total()
+    if left == 0:
+        plan.remove_plan(base)
+        return
+    print(
+        f"{left} operations are left, continue with 'cman sync --resume'.",
+        file=sys.stderr,
+    )
+    raise click.Abort()
+
+
+def list_remote(
+    client: MochiClient, deck_ids: Collection[str], estimate: int
+) -> dict[str, api.Card]:
+    """all cards of the given decks, listing all decks concurrently"""
+    progress = tqdm(total=estimate, desc="list cards")
+
+    def f(deck_id: str) -> list[api.Card]:
+        cards = []
+        for card in list_cards(client, deck_id, short_page_ends=True):
+            cards.append(card)
+            progress.update()
+        return cards
+
+    with progress, ThreadPoolExecutor(max(1, len(deck_ids))) as executor:
+        return {c.id: c for cards in executor.map(f, deck_ids) for c in cards}
+
+
+def retrieve_remote(client: MochiClient, ids: Collection[str]) -> dict[str, api.Card]:
+    """the given cards, retrieved concurrently, cards that do not exist are left out"""
+
+    def f(id: str) -> None | api.Card:
+        try:
+            return retrieve_card(client, id)
+        except ApiError as e:
+            if e.status_code == 404:
+                return None
+            raise
+
+    with ThreadPoolExecutor(max(1, min(8, len(ids)))) as executor:
+        return {c.id: c for c in executor.map(f, ids) if c is not None}
+
+
+def diff_from_snapshot(
+    client: MochiClient,
+    snapshot: dict[str, Remote],
+    existing: dict[str, Card],
+    new: list[Card],
+    decks: Mapping[str, str],
+    sample: int,
+) -> None | MochiDiff:
+    """
+    diff against the local snapshot of the remote, without listing the remote
+    a random sample of cards is retrieved to check for changes made in mochi directly
+    returns None if the snapshot cannot be trusted, then we need to list the remote
+    """
+    missing = [id for id in existing if not snapshot.get(id, Remote([])).is_complete()]
+    if len(missing) > 0:
+        print(f"{len(missing)} cards are not in the snapshot, listing remote cards.")
+        return None
+
+    def drifted(id: str) -> bool:
+        try:
+            card = retrieve_card(client, id)
+        except ApiError as e:
+            if e.status_code == 404:
+                return True
+            raise
+        return (snapshot[id].deck_id, snapshot[id].content_hash) != (
+            card.deck_id,
+            content_hash(card.content),
+        )
+
+    ids = [id for id, r in snapshot.items() if r.deck_id in decks.values()]
+    ids = random.sample(ids, min(sample, len(ids)))
+    with ThreadPoolExecutor(max(1, min(8, len(ids)))) as executor:
+        drifts = sum(executor.map(drifted, ids))
+    if drifts > 0:
+        print(
+            f"{drifts} of {len(ids)} sampled cards changed remotely, listing remote cards."
+        )
+        return None
+
+    return MochiDiff.from_snapshot(snapshot, existing, new, decks)
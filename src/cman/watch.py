@@ -0,0 +1,164 @@
+"""
+keeps the most recently modified markdown file under a folder in memory, for cman.preview
+on linux this uses inotify, through ctypes, to not need another dependency
+elsewhere, or when inotify is not available, it falls back to scanning every second
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+from collections.abc import Iterator
+from dataclasses import dataclass
+from pathlib import Path
+from threading import Condition, Thread
+
+# NOTE from /usr/include/sys/inotify.h
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+watch_mask = (
+    IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+)
+# NOTE struct inotify_event without the name that follows it
+event_header = struct.Struct("iIII")
+
+
+@dataclass(frozen=True)
+class Latest:
+    path: None | Path
+    mtime: float
+
+
+def scan(folder: Path) -> Latest:
+    """the expensive way, stat every markdown file"""
+    candidates = [(p.stat().st_mtime, p) for p in folder.glob("**/*.md")]
+    if len(candidates) == 0:
+        return Latest(None, -1)
+    mtime, path = max(candidates)
+    return Latest(path, mtime)
+
+
+def load_libc() -> None | ctypes.CDLL:
+    if not sys.platform.startswith("linux"):
+        return None
+    match ctypes.util.find_library("c"):
+        case None:
+            return None
+        case str(name):
+            libc = ctypes.CDLL(name, use_errno=True)
+            return libc if hasattr(libc, "inotify_init1") else None
+
+
+def parse_events(data: bytes) -> Iterator[tuple[int, int, str]]:
+    """watch descriptor, mask, and name, of each struct inotify_event in data"""
+    at = 0
+    while at < len(data):
+        wd, mask, _, size = event_header.unpack_from(data, at)
+        at += event_header.size
+        yield wd, mask, os.fsdecode(data[at : at + size].rstrip(b"\0"))
+        at += size
+
+
+class Watcher:
+    def __init__(self, folder: Path, debounce: float = 0.1):
+        self.folder = folder
+        # NOTE editors can write a file in several steps, we publish once it's quiet
+        self.debounce = debounce
+        self.changed = Condition()
+        self.latest = scan(folder)
+
+    def start(self):
+        Thread(target=self.run, daemon=True).start()
+
+    def wait(self, mtime: float, timeout: float) -> Latest:
+        """returns once something is newer than mtime, or after the timeout"""
+        with self.changed:
+            self.changed.wait_for(lambda: self.latest.mtime > mtime, timeout)
+            return self.latest
+
+    def publish(self, latest: Latest):
+        with self.changed:
+            if latest == self.latest:
+                return
+            self.latest = latest
+            self.changed.notify_all()
+
+    def run(self):
+        libc = load_libc()
+        if libc is not None:
+            try:
+                self.run_inotify(libc)
+            except OSError as e:
+                # NOTE for example when there are too many folders for the inotify limits
+                print(f"Cannot watch with inotify ({e}), scanning instead.")
+        self.run_scanning()
+
+    def run_scanning(self):
+        while True:
+            time.sleep(1)
+            self.publish(scan(self.folder))
+
+    def run_inotify(self, libc: ctypes.CDLL):
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        folders: dict[int, Path] = {}
+
+        def watch(folder: Path):
+            for f in [folder, *(p for p in folder.rglob("*") if p.is_dir())]:
+                wd = libc.inotify_add_watch(fd, os.fsencode(f), watch_mask)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(), f"cannot watch {f}")
+                folders[wd] = f
+
+        try:
+            watch(self.folder)
+            # NOTE the first scan was before we watched
+            self.publish(scan(self.folder))
+            while True:
+                select.select([fd], [], [])
+                candidate: None | Path = None
+                rescan = False
+                while select.select([fd], [], [], self.debounce)[0]:
+                    for wd, mask, name in parse_events(os.read(fd, 64 * 1024)):
+                        if mask & IN_Q_OVERFLOW:
+                            rescan = True
+                        elif mask & IN_IGNORED:
+                            folders.pop(wd, None)
+                        elif wd not in folders:
+                            continue
+                        elif mask & IN_ISDIR:
+                            if mask & (IN_CREATE | IN_MOVED_TO):
+                                watch(folders[wd] / name)
+                                rescan = True
+                        elif not name.endswith(".md"):
+                            continue
+                        elif mask & (IN_DELETE | IN_MOVED_FROM):
+                            rescan = rescan or folders[wd] / name == self.latest.path
+                        else:
+                            candidate = folders[wd] / name
+                if rescan:
+                    self.publish(scan(self.folder))
+                elif candidate is not None:
+                    try:
+                        mtime = candidate.stat().st_mtime
+                    except FileNotFoundError:
+                        continue
+                    if mtime >= self.latest.mtime:
+                        self.publish(Latest(candidate, mtime))
+        finally:
+            os.close(fd)
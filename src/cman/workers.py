@@ -0,0 +1,148 @@
+"""
+a pool of long-lived pandoc processes, shared by cman.markdown and cman.preview
+each worker runs pandoc-worker.lua with 'pandoc lua' and converts one request at a time
+so we pay for starting pandoc once per worker, and not once per conversion
+"""
+
+from __future__ import annotations
+
+import atexit
+import json
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from queue import Queue
+from subprocess import PIPE, Popen
+from threading import Lock
+
+from cman import profiling
+
+worker_path = Path(__file__).parent / "pandoc-worker.lua"
+worker_path = worker_path.absolute()
+
+
+class PandocError(Exception):
+    pass
+
+
+class WorkerDied(Exception):
+    pass
+
+
+@dataclass
+class Worker:
+    process: Popen[str]
+
+    @classmethod
+    def start(cls):
+        start = time.perf_counter()
+        process = Popen(
+            ["pandoc", "lua", str(worker_path)],
+            stdin=PIPE,
+            stdout=PIPE,
+            text=True,
+            encoding="utf-8",
+        )
+        worker = cls(process)
+        # NOTE health check, the worker is only used once it answered
+        assert worker.convert({"ping": True}) == "pong"
+        profiling.count("pandoc worker start", time.perf_counter() - start)
+        return worker
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def convert(self, request: dict) -> str:
+        assert self.process.stdin is not None
+        assert self.process.stdout is not None
+        try:
+            # NOTE json.dumps escapes newlines, so every request is exactly one line
+            self.process.stdin.write(json.dumps(request) + "\n")
+            self.process.stdin.flush()
+            line = self.process.stdout.readline()
+        except OSError as e:
+            raise WorkerDied() from e
+        if line == "":
+            raise WorkerDied()
+        response = json.loads(line)
+        if "error" in response:
+            raise PandocError(response["error"])
+        return response["output"]
+
+    def stop(self):
+        self.process.kill()
+        self.process.wait()
+
+
+class Pool:
+    """workers are started lazily, up to size, and restarted when they crash"""
+
+    def __init__(self, size: int):
+        assert size > 0, size
+        self.size = size
+        self.started = 0
+        self.lock = Lock()
+        self.idle: Queue[Worker] = Queue()
+        self.workers: list[Worker] = []
+
+    def acquire(self) -> Worker:
+        with self.lock:
+            if self.idle.empty() and self.started < self.size:
+                worker = Worker.start()
+                self.started += 1
+                self.workers.append(worker)
+                return worker
+        return self.idle.get()
+
+    def restart(self, worker: Worker) -> Worker:
+        worker.stop()
+        new = Worker.start()
+        with self.lock:
+            self.workers[self.workers.index(worker)] = new
+        return new
+
+    def convert(self, text: str, source: str, target: str, options: list[str]) -> str:
+        """like 'pandoc --from=source --to=target *options' with text as input"""
+        request = {"text": text, "from": source, "to": target, "options": options}
+        worker = self.acquire()
+        try:
+            if not worker.is_alive():
+                worker = self.restart(worker)
+            try:
+                return worker.convert(request)
+            except WorkerDied:
+                # NOTE retry once, a request that kills pandoc twice is not the worker's fault
+                worker = self.restart(worker)
+                return worker.convert(request)
+        finally:
+            self.idle.put(worker)
+
+    def stop(self):
+        with self.lock:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+
+
+pool: None | Pool = None
+
+
+def start(size: int):
+    """start the shared pool, a size of 0 keeps using one pandoc process per conversion"""
+    global pool
+    if size == 0 or pool is not None:
+        return
+    pool = Pool(size)
+    atexit.register(pool.stop)
+
+
+def size() -> int:
+    return 0 if pool is None else pool.size
+
+
+def start_in_child(size: int):
+    """for forked processes, they cannot share the workers of their parent"""
+    global pool
+    pool = None
+    # NOTE a child converts one thing at a time, more workers would just idle
+    start(min(size, 1))